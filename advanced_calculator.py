@@ -1,4 +1,17 @@
+import heapq
+import math
+from time import perf_counter
+
 from calculator import Calculator
+from history import StepHistory
+from optimizer import shareSubexpressions
+from stack import Stack
+from tokenizer import tokenize, InvalidExpression, NAME, WHITESPACE
+
+try:
+    import numpy
+except ImportError:     # numpy is only needed for calculateVectorized
+    numpy = None
 
 class AdvancedCalculator:
     '''
@@ -35,13 +48,31 @@ class AdvancedCalculator:
         >>> C.states == {}
         True
     '''
-    def __init__(self):
+    def __init__(self, cache=None, metrics=None, history="full", cse=False, executor=None, memo=None):
         self.expressions = ''
         self.states = {}
+        # How steps are kept: "full" dict snapshots, "delta" StepHistory, or "none"
+        if history not in ("full", "delta", "none"):
+            raise ValueError("history must be 'full', 'delta' or 'none'")
+        self.history = history
+        # Evaluate repeated subexpressions once per run (see optimizer.shareSubexpressions)
+        self.cse = cse
+        # Optional concurrent.futures executor: independent statements run concurrently
+        self.executor = executor
+        # Optional ResultCache of finished runs, keyed on the compiled script and bindings
+        self.memo = memo
+        # Optional ParseCache and Metrics handed to every Calculator this instance creates
+        self.cache = cache
+        self.metrics = metrics
+        # Last run and its dependency graph, used by updateStatement/updateInput
+        self.__lastRun = None
+        self.__graph = None
 
     def setExpression(self, expression):
         self.expressions = expression
         self.states = {}
+        self.__lastRun = None
+        self.__graph = None
 
     def _isVariable(self, word):
         '''
@@ -56,19 +87,7 @@ class AdvancedCalculator:
             False
         '''
 
-        if not isinstance(word, str):
-            return False
-
-        # Variables must start with a letter
-        if not word[0].isalpha():
-            return False
-
-        # Variables can only contain alphanumeric characters
-        for ch in word:
-            if not ch.isalnum():
-                return False
-        
-        return True
+        return _isVariable(word)
 
 
     def _replaceVariables(self, expr):
@@ -82,56 +101,829 @@ class AdvancedCalculator:
             '7 * ( 23.0 - 1 )'
             >>> C._replaceVariables('x2 - x1')
             '28.0 - 23.0'
+            >>> C.states = {'x1': 1.0, 'x10': 2.0}
+            >>> C._replaceVariables('x10 + x1')
+            '2.0 + 1.0'
         '''
 
-        replaced = expr
-        for var in self.states:
-            # Only attempt replacement if `var` is a variable
-            if self._isVariable(var):
-                replaced = replaced.replace(var, str(self.states[var]))
+        metrics = self.metrics
+        if metrics is not None:
+            start = perf_counter()
 
-        for term in replaced.split(" "):
-            if self._isVariable(term):
-                return None
+        # Only whole NAME tokens are replaced, so `x1` never matches inside `x10`
+        try:
+            tokens = tokenize(expr, names=True)
+        except InvalidExpression:
+            tokens = None
 
+        replaced = None
+        if tokens is not None:
+            terms = []
+            for token in tokens:
+                if token.kind is NAME:
+                    if token.text not in self.states:
+                        terms = None
+                        break
+                    terms.append(str(self.states[token.text]))
+                else:
+                    terms.append(token.text)
+            if terms is not None:
+                replaced = " ".join(terms)
+
+        if metrics is not None:
+            metrics.record("substitute", perf_counter() - start)
+            if replaced is None:
+                metrics.increment("undefinedVariables")
         return replaced
 
     
-    def calculateExpressions(self):
-        self.states = {} 
-        calcObj = Calculator()     # method must use calcObj to compute each expression
+    def _compileScript(self, inputs=()):
+        # See compileScript
+        return compileScript(self.expressions, inputs, self.cache, self.metrics)
 
-        steps = {}
-        exprs = self.expressions.split(";")
-        final_eq = exprs.pop()[7:]
-
-        # Iterate over each expression that is setting a variable and add to state
-        for expr in exprs:
-            split_expr = expr.split("=")
-            var = split_expr[0].strip()
-            var_equals = split_expr[-1].strip()
-            replaced = self._replaceVariables(var_equals)
-            # Return None if variables are not defined
-            if replaced is None:
-                self.states = {}
+
+    def calculateVectorized(self, columns):
+        '''
+            Run the script once over whole columns of input values. `columns` maps
+            variable names to arrays with one element per row; every statement is
+            compiled once and its postfix program is evaluated on the arrays with NumPy.
+            Returns the final value of every variable plus `_return_`, each as an array
+            with one element per row, or None if the script is invalid. Results follow
+            NumPy semantics, e.g. division by zero gives inf rather than an error.
+
+            >>> C = AdvancedCalculator()
+            >>> C.setExpression('c = a * b + 2;d = 10;return c - d')
+            >>> out = C.calculateVectorized({'a': [1, 2, 3], 'b': [4.0, 5.0, 6.0]})
+            >>> out['c'].tolist(), out['d'].tolist(), out['_return_'].tolist()
+            ([6.0, 12.0, 20.0], [10.0, 10.0, 10.0], [-4.0, 2.0, 10.0])
+            >>> C.setExpression('c = a * x;return c')
+            >>> C.calculateVectorized({'a': [1, 2, 3]}) is None
+            True
+        '''
+        if numpy is None:
+            raise ImportError("calculateVectorized requires numpy")
+
+        script = self._compileScript(tuple(columns))
+        if script is None:
+            return None
+
+        values = [None] * len(script.names)
+        for var, column in columns.items():
+            values[script.symbols[var]] = numpy.asarray(column, dtype=numpy.float64)
+        # Every result has one element per row, even for constant statements
+        shape = numpy.broadcast_shapes(*[values[script.symbols[var]].shape for var in columns])
+
+        states = {}
+        for var in columns:
+            states[var] = values[script.symbols[var]]
+        with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for expr, var, slot, program in script.statements:
+                value = numpy.broadcast_to(numpy.asarray(program.evaluate(values), dtype=numpy.float64), shape)
+                values[slot] = value
+                states[var] = value
+            states["_return_"] = numpy.broadcast_to(numpy.asarray(script.result.evaluate(values), dtype=numpy.float64), shape)
+        return states
+
+
+    def calculateExpressions(self, bindings=None):
+        '''
+            Run the script and return the state after every statement plus `_return_`.
+            `bindings` optionally gives initial values for variables the script reads
+            without assigning them first. With history="delta" the steps are a
+            StepHistory that stores one value per step and rebuilds states on demand;
+            with history="none" only `_return_` is kept. With `cse` set, subexpressions
+            repeated across statements are evaluated once; with an `executor`,
+            statements that don't depend on each other are evaluated concurrently.
+            With a `memo` ResultCache, a script that was already run with the same
+            bindings is not evaluated again. The steps are the same either way.
+
+            >>> C = AdvancedCalculator()
+            >>> C.setExpression('b = a * 2;return b + a')
+            >>> C.calculateExpressions({'a': 3.0})
+            {'b = a * 2': {'a': 3.0, 'b': 6.0}, '_return_': 9.0}
+            >>> C.history = "none"
+            >>> C.calculateExpressions({'a': 3.0})
+            {'_return_': 9.0}
+            >>> C.states
+            {'a': 3.0, 'b': 6.0}
+            >>> C = AdvancedCalculator(cse=True)
+            >>> C.setExpression('x = ( a + b ) * 2;a = 7;y = ( a + b ) * 2;return x + y')
+            >>> C.calculateExpressions({'a': 1.0, 'b': 2.0})
+            {'x = ( a + b ) * 2': {'a': 1.0, 'b': 2.0, 'x': 6.0}, 'a = 7': {'a': 7.0, 'b': 2.0, 'x': 6.0}, 'y = ( a + b ) * 2': {'a': 7.0, 'b': 2.0, 'x': 6.0, 'y': 18.0}, '_return_': 24.0}
+        '''
+        self.states = {}
+        self.__graph = None
+        self.__lastRun = None
+        bindings = _floatBindings(bindings)
+        run = _runScript(self.expressions, bindings, self.cache, self.metrics, self.history, self.cse,
+                         self.executor, self.memo)
+        # Return None if a statement is invalid or variables are not defined
+        if run is None:
+            return None
+
+        steps, self.states, script, results = run
+        # Kept so updateStatement/updateInput can recompute incrementally
+        self.__lastRun = (script, results, steps["_return_"], dict(bindings))
+        return steps
+
+
+    def _scriptGraph(self):
+        if self.__graph is None:
+            if self.__lastRun is None:
                 return None
-            calcObj.setExpr(replaced)
-            self.states[var] = calcObj.calculate
+            self.__graph = ScriptGraph(*self.__lastRun)
+        return self.__graph
+
+
+    def updateStatement(self, index, statement):
+        '''
+            Replace the assignment at `index` with `statement` after a call to
+            calculateExpressions, and recompute only the statements that depend on it,
+            directly or through other statements. The returned steps and `states`
+            match a full rerun of the updated script. Returns None, and leaves the
+            script unchanged, if the new statement is invalid.
+
+            >>> C = AdvancedCalculator()
+            >>> C.setExpression('a = 5;b = 7 + a;c = 2;d = c * b;return d')
+            >>> C.calculateExpressions()['_return_']
+            24.0
+            >>> C.updateStatement(2, 'c = 3') == {'a = 5': {'a': 5.0}, 'b = 7 + a': {'a': 5.0, 'b': 12.0}, 'c = 3': {'a': 5.0, 'b': 12.0, 'c': 3.0}, 'd = c * b': {'a': 5.0, 'b': 12.0, 'c': 3.0, 'd': 36.0}, '_return_': 36.0}
+            True
+            >>> C.expressions
+            'a = 5;b = 7 + a;c = 3;d = c * b;return d'
+            >>> C.updateStatement(0, 'a = x')
+            >>> C.states['d']
+            36.0
+
+            An update that raises leaves the script as it was:
+
+            >>> C.setExpression('a = 1;b = 2 / a;c = 5;return b + c')
+            >>> C.calculateExpressions()['_return_']
+            7.0
+            >>> C.updateStatement(0, 'a = 0')
+            Traceback (most recent call last):
+            ...
+            ZeroDivisionError: float division by zero
+            >>> C.updateStatement(2, 'c = 6')
+            {'a = 1': {'a': 1.0}, 'b = 2 / a': {'a': 1.0, 'b': 2.0}, 'c = 6': {'a': 1.0, 'b': 2.0, 'c': 6.0}, '_return_': 8.0}
+            >>> C.updateStatement(-1, 'c = 7')
+            Traceback (most recent call last):
+            ...
+            IndexError: statement index out of range
+
+            A change in the sign of zero reaches the statements that read it:
+
+            >>> C.setExpression('a = 1;b = a * 2;return b')
+            >>> _ = C.calculateExpressions()
+            >>> _ = C.updateStatement(0, 'a = 0')
+            >>> C.updateStatement(0, 'a = 0 * -1')['_return_']
+            -0.0
+        '''
+        graph = self._scriptGraph()
+        if graph is None:
+            raise RuntimeError("calculateExpressions must run before updateStatement")
+        # A negative index would replace the return statement in `expressions`
+        if not 0 <= index < len(graph.statements):
+            raise IndexError("statement index out of range")
+
+        try:
+            expr, var, var_equals, tokens = _parseAssignment(statement, 0, len(statement))
+        except InvalidExpression:
+            if self.metrics is not None:
+                self.metrics.increment("invalidExpressions")
+            return None
+        program = Calculator.compile(var_equals, self.cache, names=True, metrics=self.metrics, tokens=tokens)
+        if program is None or not graph.replace(index, expr, var, program):
+            if self.metrics is not None and program is not None:
+                self.metrics.increment("undefinedVariables")
+            return None
+
+        exprs = self.expressions.split(";")
+        exprs[index] = expr
+        self.expressions = ";".join(exprs)
+        return self.__publish(graph)
+
+
+    def updateInput(self, name, value):
+        '''
+            Change one of the bindings given to calculateExpressions and recompute only
+            the statements that depend on it.
+
+            >>> C = AdvancedCalculator()
+            >>> C.setExpression('b = a * 2;c = 1;return b + c')
+            >>> C.calculateExpressions({'a': 1.0})['_return_']
+            3.0
+            >>> C.updateInput('a', 10.0)
+            {'b = a * 2': {'a': 10.0, 'b': 20.0}, 'c = 1': {'a': 10.0, 'b': 20.0, 'c': 1.0}, '_return_': 21.0}
+            >>> C.setExpression('b = 2 / a;return b')
+            >>> C.calculateExpressions({'a': 1.0})['_return_']
+            2.0
+            >>> C.updateInput('a', 0.0)
+            Traceback (most recent call last):
+            ...
+            ZeroDivisionError: float division by zero
+            >>> C.updateInput('a', 4.0)
+            {'b = 2 / a': {'a': 4.0, 'b': 0.5}, '_return_': 0.5}
+        '''
+        graph = self._scriptGraph()
+        if graph is None:
+            raise RuntimeError("calculateExpressions must run before updateInput")
+        if name not in graph.bindings:
+            raise KeyError(name)
+        graph.setInput(name, _floatBindings({name: value})[name])
+        return self.__publish(graph)
+
+
+    def __publish(self, graph):
+        steps, self.states = graph.steps(self.history)
+        return steps
+
+
+def parseScript(text):
+    '''
+        Parse a whole script in one pass into its assignments and the expression
+        after `return`. Statements are separated by `;` and may be surrounded by any
+        whitespace, newlines included, and a `;` after the return expression is
+        allowed. Each assignment is a (statement, variable, expression, tokens)
+        tuple, where `statement` is the raw text between two separators, and the
+        result is an (expression, tokens) pair. Invalid scripts raise
+        InvalidExpression with the position of the error in `text`.
+
+        >>> assignments, result = parseScript('a = 5;\\n  b = 7 + a;\\nreturn a * b;\\n')
+        >>> [(statement, var, expr) for statement, var, expr, tokens in assignments]
+        [('a = 5', 'a', '5'), ('\\n  b = 7 + a', 'b', '7 + a')]
+        >>> result
+        ('a * b', [Token(name, 'a'), Token(operator, '*'), Token(name, 'b')])
+        >>> parseScript('a = 5;2b = a;return b')
+        Traceback (most recent call last):
+        ...
+        tokenizer.InvalidExpression: invalid variable name at position 6
+        >>> parseScript('a = 5;b = a = 3;return b')
+        Traceback (most recent call last):
+        ...
+        tokenizer.InvalidExpression: unsupported character '=' at position 12
+        >>> parseScript('a = 5;a * 2')
+        Traceback (most recent call last):
+        ...
+        tokenizer.InvalidExpression: missing return at position 6
+    '''
+    assignments = list(_scanStatements(text))
+    statement, var, expr, tokens = assignments.pop()
+    return assignments, (expr, tokens)
+
+
+def compileScript(text, inputs=(), cache=None, metrics=None):
+    '''
+        Compile every statement of a script once and resolve its variables to
+        symbol-table slots. Names in `inputs` are given the first slots and may be
+        read before they are assigned. Returns None if a statement is invalid or
+        reads an undefined variable.
+
+        >>> script = compileScript('a = 5;b = 7 + a;a = b * 2;return a - b')
+        >>> script.names
+        ('a', 'b')
+        >>> [(var, slot, str(program)) for expr, var, slot, program in script.statements]
+        [('a', 0, '5.0'), ('b', 1, '7.0 a +'), ('a', 0, 'b 2.0 *')]
+        >>> compileScript('a = 5;return a + b') is None
+        True
+    '''
+    key = ("script", text, tuple(inputs))
+    if cache is not None:
+        # Invalid scripts are cached as None, so use False to detect a miss
+        script = cache.get(key, False)
+        if script is not False:
+            return script
+
+    script = _buildScript(text, inputs, cache, metrics)
+    if cache is not None:
+        cache.put(key, script)
+    return script
+
+
+def runScript(script, bindings=None, cache=None, metrics=None, history="full", cse=False, executor=None,
+              memo=None):
+    '''
+        Stateless version of AdvancedCalculator.calculateExpressions: run `script`
+        with the initial `bindings` and return its steps, or None if the script is
+        invalid. Nothing is shared between calls apart from the optional cache and
+        metrics, which are locked, so it can be called from many threads at once.
+
+        >>> runScript('b = a * 2;return b + a', {'a': 3.0})
+        {'b = a * 2': {'a': 3.0, 'b': 6.0}, '_return_': 9.0}
+        >>> runScript('b = a * 2;return b + a') is None
+        True
+        >>> runScript('b = a * 1;return b', {'a': 3})
+        {'b = a * 1': {'a': 3.0, 'b': 3.0}, '_return_': 3.0}
+        >>> from concurrent.futures import ThreadPoolExecutor
+        >>> with ThreadPoolExecutor(2) as pool:
+        ...     runScript('b = a * 2;c = a + 1;d = b * c;return d', {'a': 3.0}, history="none", executor=pool)
+        {'_return_': 24.0}
+    '''
+    if history not in ("full", "delta", "none"):
+        raise ValueError("history must be 'full', 'delta' or 'none'")
+    run = _runScript(script, _floatBindings(bindings), cache, metrics, history, cse, executor, memo)
+    return None if run is None else run[0]
+
+
+def _runScript(text, bindings, cache, metrics, history, cse=False, executor=None, memo=None):
+    # Returns (steps, states, compiled script, per-statement results) or None
+    inputs = tuple(bindings)
+    memoInputs = None if memo is None else _memoInputs(bindings)
+    if memoInputs is not None:
+        # The same text with the same bindings needs neither parsing nor evaluation
+        textKey = ("script", "text", text, memoInputs)
+        hit = memo.get(textKey)
+        if hit is not None:
+            script, results, result = hit
+            steps, states = _buildSteps(script, bindings, results, result, history)
+            return steps, states, script, list(results)
+
+    script = compileScript(text, inputs, cache, metrics)
+    if script is None:
+        return None
+
+    if metrics is not None:
+        start = perf_counter()
+
+    hit = None
+    if memoInputs is not None:
+        # Scripts that only differ in formatting share their results
+        key = ("script", "canonical", script.canonical, memoInputs)
+        hit = memo.get(key)
+    if hit is not None:
+        results, result = list(hit[0]), hit[1]
+    elif cse:
+        # Every distinct subexpression of the script is evaluated once, up front
+        shared = _shareScript(script, inputs, cache)
+        sharedValues = shared.evaluate(bindings)
+        results = [sharedValues[value] for expr, var, value in shared.statements]
+        result = sharedValues[shared.result]
+    elif executor is not None:
+        results, result = _evaluateLevels(script, bindings, executor)
+    else:
+        results, result = _evaluateInOrder(script, bindings)
+    if memoInputs is not None:
+        if hit is None:
+            memo.put(key, (tuple(results), result))
+        memo.put(textKey, (script, tuple(results), result))
+
+    steps, states = _buildSteps(script, bindings, results, result, history)
+    if metrics is not None:
+        metrics.record("evaluate", perf_counter() - start)
+    return steps, states, script, results
 
+
+def _buildSteps(script, bindings, results, result, history):
+    states = dict(bindings)
+    steps = {}
+    if history == "delta":
+        steps = StepHistory(bindings)
+
+    # Iterate over each expression that is setting a variable and add to state
+    for (expr, var, slot, program), value in zip(script.statements, results):
+        states[var] = value
+
+        if history == "full":
             # Create a new dict in memory to store the state of current step
-            current_state = {}
-            for key, value in self.states.items():
-                current_state[key] = value
-            steps[expr] = current_state
-
-        # Replace variables in final expression and calculate
-        final = self._replaceVariables(final_eq)
-        calcObj.setExpr(final)
-        calculation = calcObj.calculate
-        # `calculation` returns None if there is an invalid expression
-        if calculation is None:
-            self.states = {}
+            steps[expr] = dict(states)
+        elif history == "delta":
+            # Only the variable that changed is recorded
+            steps.record(expr, var, value)
+
+    if history == "delta":
+        steps.setResult(result)
+    else:
+        steps["_return_"] = result
+    return steps, states
+
+
+def _floatBindings(bindings):
+    # Programs compute in floats, and folding drops identities such as `a * 1`, so
+    # an int binding would otherwise come back as an int. Values float() rejects
+    # with a TypeError, e.g. NumPy arrays or complex numbers, are kept as they are.
+    floats = {}
+    if bindings is not None:
+        for name, value in bindings.items():
+            try:
+                value = float(value)
+            except TypeError:
+                pass
+            floats[name] = value
+    return floats
+
+
+def _sameValue(value, old):
+    # nan never equals itself, and 0.0 == -0.0 even though the sign can change
+    # later results, e.g. 1 / value
+    if value != value:
+        return old != old
+    if value != old or value.__class__ is not old.__class__:
+        return False
+    if value.__class__ is float:
+        return math.copysign(1.0, value) == math.copysign(1.0, old)
+    return True
+
+
+def _evaluateInOrder(script, bindings):
+    # Values stay floats in their symbol-table slots for the whole run
+    values = [None] * len(script.names)
+    for var, value in bindings.items():
+        values[script.symbols[var]] = value
+    calcStack = Stack()
+    results = []
+    for expr, var, slot, program in script.statements:
+        value = program.evaluate(values, calcStack)
+        values[slot] = value
+        results.append(value)
+    return results, script.result.evaluate(values, calcStack)
+
+
+def _statementLevels(script):
+    '''
+        Group the statements of a compiled script into levels that can run
+        concurrently. Every read is linked to the statement whose value it sees, so
+        a statement only waits for the assignments it really reads; reassigning a
+        variable does not order two statements. Returns the levels as lists of
+        statement indexes plus, for every statement and the return expression, its
+        reads as (slot, writer) pairs with writer None for an input binding.
+
+        >>> levels, reads = _statementLevels(compileScript('a = 5;b = a * 2;a = 7;c = a + b;return c', ()))
+        >>> levels
+        [[0, 2], [1], [3]]
+        >>> reads[3]
+        ((0, 2), (1, 1))
+    '''
+    lastWriter = {}
+    levelOf = []
+    levels = []
+    reads = []
+
+    def link(program):
+        return tuple((script.symbols[name], lastWriter.get(name)) for name in program.variables)
+
+    for index, (expr, var, slot, program) in enumerate(script.statements):
+        statementReads = link(program)
+        level = 0
+        for readSlot, writer in statementReads:
+            if writer is not None and levelOf[writer] >= level:
+                level = levelOf[writer] + 1
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(index)
+        levelOf.append(level)
+        reads.append(statementReads)
+        lastWriter[var] = index
+    reads.append(link(script.result))
+    return levels, reads
+
+
+def _evaluateLevels(script, bindings, executor, chunksize=256):
+    levels, reads = _statementLevels(script)
+    statements = script.statements
+    symbols = script.symbols
+    inputs = {symbols[var]: value for var, value in bindings.items()}
+    results = [None] * len(statements)
+
+    def env(statementReads):
+        return {slot: inputs[slot] if writer is None else results[writer] for slot, writer in statementReads}
+
+    try:
+        for level in levels:
+            jobs = [(statements[index][3], env(reads[index])) for index in level]
+            chunks = [jobs[i:i + chunksize] for i in range(0, len(jobs), chunksize)]
+            values = []
+            # map() yields the chunks back in submission order
+            for chunk in executor.map(_evaluateStatements, chunks):
+                values.extend(chunk)
+            for index, value in zip(level, values):
+                results[index] = value
+    except ArithmeticError:
+        # Report the same error as an in-order run would
+        return _evaluateInOrder(script, bindings)
+    return results, script.result.evaluate(env(reads[-1]))
+
+
+def _evaluateStatements(jobs):
+    # Module level so it can be pickled and sent to worker processes
+    calcStack = Stack()
+    return [program.evaluate(values, calcStack) for program, values in jobs]
+
+
+def _memoInputs(bindings):
+    # None when a binding can't be part of a key, e.g. a NumPy array or a complex number
+    try:
+        # The type and sign keep 1 apart from 1.0 and -0.0 apart from 0.0
+        inputs = tuple(sorted((name, value.__class__, value, math.copysign(1.0, value))
+                              for name, value in bindings.items()))
+        hash(inputs)
+    except TypeError:
+        return None
+    return inputs
+
+
+def _shareScript(script, inputs, cache):
+    key = ("shared", script.source, inputs)
+    if cache is not None:
+        shared = cache.get(key, None)
+        if shared is not None:
+            return shared
+    shared = shareSubexpressions(script)
+    if cache is not None:
+        cache.put(key, shared)
+    return shared
+
+
+def _buildScript(text, inputs, cache, metrics):
+    symbols = {}
+    for var in inputs:
+        symbols.setdefault(var, len(symbols))
+
+    # Statements are compiled as they are scanned, so only one statement's tokens
+    # are alive at a time
+    statements = []
+    try:
+        if metrics is not None:
+            start = perf_counter()
+        for expr, var, var_equals, tokens in _scanStatements(text):
+            if metrics is not None:
+                metrics.record("tokenize", perf_counter() - start)
+                metrics.increment("tokens", len(tokens))
+            program = _compileStatement(var_equals, symbols, cache, metrics, tokens)
+            if program is None:
+                return None
+            if var is None:
+                # The return expression is always the last statement
+                return CompiledScript(statements, program, symbols, text)
+            # The slot is assigned after compiling, so `a = a + 1` needs an earlier `a`
+            slot = symbols.setdefault(var, len(symbols))
+            statements.append((expr, var, slot, program))
+            if metrics is not None:
+                start = perf_counter()
+    except InvalidExpression:
+        if metrics is not None:
+            metrics.record("tokenize", perf_counter() - start)
+            metrics.increment("invalidExpressions")
+        return None
+
+
+def _compileStatement(expr, symbols, cache, metrics, tokens=None):
+    program = Calculator.compile(expr, cache, names=True, metrics=metrics, tokens=tokens)
+    if program is None:
+        return None
+    # Resolving variables to slots is the script's substitute phase
+    if metrics is not None:
+        start = perf_counter()
+    for var in program.variables:
+        if var not in symbols:
+            if metrics is not None:
+                metrics.record("substitute", perf_counter() - start)
+                metrics.increment("undefinedVariables")
             return None
-        else:
-            steps["_return_"] = calcObj.calculate
-            return steps
\ No newline at end of file
+    program = program.resolve(symbols)
+    if metrics is not None:
+        metrics.record("substitute", perf_counter() - start)
+    return program
+
+
+def _scanStatements(text):
+    # Yields (statement, variable, expression, tokens) for every assignment, then
+    # the return statement with None as its variable
+    if not isinstance(text, str):
+        raise InvalidExpression(0, "script must be a string")
+
+    # A `;` after the return expression ends the script
+    end = len(text)
+    last = text.rfind(";")
+    if last >= 0 and _skipWhitespace(text, last + 1, end) == end:
+        end = last
+
+    start = 0
+    stop = text.find(";", 0, end)
+    while stop >= 0:
+        yield _parseAssignment(text, start, stop)
+        start = stop + 1
+        stop = text.find(";", start, end)
+
+    # `return` must be a word of its own, so `returned = 1` is not mistaken for it
+    first = _skipWhitespace(text, start, end)
+    begin = first + 6
+    if not text.startswith("return", first, end) or (begin < end and text[begin].isalnum()):
+        raise InvalidExpression(first, "missing return")
+    yield text[start:end], None, text[begin:end].strip(), tokenize(text, True, start=begin, end=end)
+
+
+def _parseAssignment(text, start, stop):
+    # Parses `variable = expression` in text[start:stop]
+    equals = text.find("=", start, stop)
+    if equals < 0:
+        raise InvalidExpression(_skipWhitespace(text, start, stop), "missing '='")
+    var = text[start:equals].strip()
+    if not _isVariable(var):
+        raise InvalidExpression(_skipWhitespace(text, start, stop), "invalid variable name")
+    tokens = tokenize(text, True, start=equals + 1, end=stop)
+    return text[start:stop], var, text[equals + 1:stop].strip(), tokens
+
+
+def _skipWhitespace(text, start, end):
+    while start < end and text[start] in WHITESPACE:
+        start += 1
+    return start
+
+
+def _isVariable(word):
+    if not isinstance(word, str) or not word:
+        return False
+
+    # Variables must start with a letter and only contain alphanumeric characters
+    return word[0].isalpha() and word.isalnum()
+
+
+class CompiledScript:
+    '''
+        AdvancedCalculator script compiled once: a tuple of (statement, variable,
+        slot, program) assignments and the `result` program after `return`. Every
+        program reads its variables from a list of values indexed by slot.
+    '''
+    __slots__ = ('statements', 'result', 'symbols', 'names', 'source', '_canonical')
+
+    def __init__(self, statements, result, symbols, source=None):
+        self.statements = tuple(statements)
+        self.result = result
+        self.symbols = dict(symbols)
+        # names[slot] is the variable stored in that slot
+        self.names = tuple(sorted(symbols, key=symbols.get))
+        self.source = source
+        self._canonical = None
+
+    @property
+    def canonical(self):
+        '''
+            Formatting-independent form of the script: each assignment as its variable
+            and postfix program, plus the return program. Scripts that only differ in
+            spacing have the same canonical form.
+
+            >>> compileScript('a = 5;b = a*2;return b').canonical == compileScript('a=5 ; b = a * 2 ;return b').canonical
+            True
+        '''
+        if self._canonical is None:
+            self._canonical = (tuple((var, str(program)) for expr, var, slot, program in self.statements),
+                               str(self.result))
+        return self._canonical
+
+    def __len__(self):
+        return len(self.statements)
+
+
+class ScriptGraph:
+    '''
+        Dependency graph of a compiled script's assignments, used to recompute only
+        what an update affects. Every read is linked to the statement whose value it
+        sees (or to an input binding), so reassignments are handled correctly.
+    '''
+    def __init__(self, script, results, result, bindings):
+        self.symbols = dict(script.symbols)
+        self.statements = list(script.statements)
+        self.returnProgram = script.result
+        self.results = list(results)
+        self.result = result
+        self.bindings = bindings
+        self._link()
+
+    def _reads(self, program, lastWriter):
+        # (slot, name, writer) for every variable, writer None means an input binding
+        reads = []
+        for name in program.variables:
+            writer = lastWriter.get(name)
+            if writer is None and name not in self.bindings:
+                return None
+            reads.append((self.symbols[name], name, writer))
+        return tuple(reads)
+
+    def _link(self):
+        lastWriter = {}
+        reads = []
+        for index, (expr, var, slot, program) in enumerate(self.statements):
+            statementReads = self._reads(program, lastWriter)
+            if statementReads is None:
+                return False
+            reads.append(statementReads)
+            lastWriter[var] = index
+        returnReads = self._reads(self.returnProgram, lastWriter)
+        if returnReads is None:
+            return False
+
+        dependents = [[] for _ in self.statements]
+        inputDependents = {}
+        for index, statementReads in enumerate(reads + [returnReads]):
+            for slot, name, writer in statementReads:
+                if writer is None:
+                    inputDependents.setdefault(name, []).append(index)
+                else:
+                    dependents[writer].append(index)
+
+        self.reads = reads
+        self.returnReads = returnReads
+        self.dependents = dependents
+        self.inputDependents = inputDependents
+        return True
+
+    def _env(self, reads):
+        env = {}
+        for slot, name, writer in reads:
+            env[slot] = self.bindings[name] if writer is None else self.results[writer]
+        return env
+
+    def _recompute(self, dirty):
+        # Visit dirty statements in order; len(statements) stands for the return expression
+        last = len(self.statements)
+        heap = list(set(dirty))
+        heapq.heapify(heap)
+        seen = set(heap)
+        calcStack = Stack()
+        while heap:
+            index = heapq.heappop(heap)
+            if index == last:
+                self.result = self.returnProgram.evaluate(self._env(self.returnReads), calcStack)
+                continue
+            program = self.statements[index][3]
+            value = program.evaluate(self._env(self.reads[index]), calcStack)
+            old = self.results[index]
+            self.results[index] = value
+            # Only propagate if the value really changed
+            if _sameValue(value, old):
+                continue
+            for dependent in self.dependents[index]:
+                if dependent not in seen:
+                    seen.add(dependent)
+                    heapq.heappush(heap, dependent)
+
+    def replace(self, index, expr, var, program):
+        '''
+            Replace statement `index` and recompute what depends on it. Returns False,
+            leaving the graph unchanged, if the statement reads an undefined variable.
+        '''
+        if not 0 <= index < len(self.statements):
+            raise IndexError("statement index out of range")
+        for name in program.variables:
+            if name not in self.symbols:
+                return False
+        saved = self._save()
+        oldReads = self.reads + [self.returnReads]
+        slot = self.symbols.setdefault(var, len(self.symbols))
+        self.statements[index] = (expr, var, slot, program.resolve(self.symbols))
+        try:
+            if not self._link():
+                self._restore(saved)
+                return False
+
+            # Changing the target variable can change which value later statements see
+            dirty = {index}
+            for other, reads in enumerate(self.reads + [self.returnReads]):
+                if reads != oldReads[other]:
+                    dirty.add(other)
+            self.results[index] = None
+            self._recompute(dirty)
+        except BaseException:
+            # e.g. a division by zero part way through: go back to the last good run
+            self._restore(saved)
+            raise
+        return True
+
+    def setInput(self, name, value):
+        saved = self._save()
+        self.bindings[name] = value
+        try:
+            self._recompute(self.inputDependents.get(name, ()))
+        except BaseException:
+            self._restore(saved)
+            raise
+
+    def _save(self):
+        # Everything an update changes, so a failed update can be undone
+        return (list(self.statements), dict(self.symbols), list(self.results), self.result, dict(self.bindings),
+                self.reads, self.returnReads, self.dependents, self.inputDependents)
+
+    def _restore(self, saved):
+        (self.statements, self.symbols, self.results, self.result, bindings,
+         self.reads, self.returnReads, self.dependents, self.inputDependents) = saved
+        # The bindings dict is shared with the caller's last run, so update it in place
+        self.bindings.clear()
+        self.bindings.update(bindings)
+
+    def steps(self, history="full"):
+        # Rebuild the steps and final states from the per-statement results
+        if history == "delta":
+            steps = StepHistory(self.bindings)
+            for (expr, var, slot, program), value in zip(self.statements, self.results):
+                steps.record(expr, var, value)
+            steps.setResult(self.result)
+            return steps, steps.states
+
+        states = dict(self.bindings)
+        steps = {}
+        for (expr, var, slot, program), value in zip(self.statements, self.results):
+            states[var] = value
+            if history == "full":
+                steps[expr] = dict(states)
+        steps["_return_"] = self.result
+        return steps, states
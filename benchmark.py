@@ -0,0 +1,223 @@
+'''
+    Reproducible benchmarks for each stage of the calculator pipeline.
+
+    python benchmark.py --output results.json
+    python benchmark.py --compare results.json --threshold 0.1
+
+    Workloads are generated from a fixed seed and scale in expression length,
+    nesting depth, variable count and statement count. Each case reports the best
+    per-call time over several repeats. In compare mode, any case slower than the
+    baseline by more than the threshold is flagged and the exit status is 1.
+'''
+import argparse
+import json
+import platform
+import random
+import string
+import sys
+import time
+
+from advanced_calculator import AdvancedCalculator
+from calculator import Calculator
+
+SEED = 20240501
+OPERATORS = "+-*/^"
+
+
+def genExpression(rng, length, depth):
+    '''
+        Generate a valid expression with `length` binary operators and parentheses
+        nested `depth` levels deep. Exponents are kept small to avoid overflow.
+
+        >>> genExpression(random.Random(1), 3, 1)
+        '( 3 ^ 1 ) / 5 + 8'
+    '''
+    if depth > 0:
+        # Nest half of the operators in a parenthesized group, the rest stays flat
+        inner = length // 2
+        group = "( " + genExpression(rng, inner, depth - 1) + " )"
+        if length == 0:
+            return group
+        rest = genExpression(rng, length - 1 - inner, 0)
+        op = rng.choice(OPERATORS[:-1])
+        return group + " " + op + " " + rest
+
+    terms = [str(rng.randint(1, 9))]
+    op = None
+    for _ in range(length):
+        # Never chain exponents, so long expressions stay finite
+        op = rng.choice(OPERATORS[:-1] if op == "^" else OPERATORS)
+        terms.append(op)
+        terms.append(str(rng.randint(1, 2)) if op == "^" else str(rng.randint(1, 9)))
+    return " ".join(terms)
+
+
+def variableNames(count):
+    '''
+        Fixed width upper case names, so no name is a substring of another or of a
+        formatted float.
+
+        >>> variableNames(3)
+        ['VAA', 'VAB', 'VAC']
+    '''
+    letters = string.ascii_uppercase
+    return ["V" + letters[i // 26 % 26] + letters[i % 26] for i in range(count)]
+
+
+def genScript(rng, statements, variables):
+    '''
+        Generate an AdvancedCalculator script with `statements` assignments over
+        `variables` distinct names. Every name is assigned before it is read.
+
+        >>> genScript(random.Random(1), 3, 2)
+        'VAA = 3;VAB = ( VAA + 2 ) / 2;VAA = ( VAB + VAA ) / 2;return VAA + VAB'
+    '''
+    names = variableNames(variables)
+    assigned = []
+    lines = []
+    for i in range(statements):
+        var = names[i % variables]
+        if len(assigned) >= 2:
+            a, b = rng.sample(assigned, 2)
+            lines.append("{} = ( {} + {} ) / 2".format(var, a, b))
+        elif assigned:
+            lines.append("{} = ( {} + {} ) / 2".format(var, assigned[0], rng.randint(1, 9)))
+        else:
+            lines.append("{} = {}".format(var, rng.randint(1, 9)))
+        if var not in assigned:
+            assigned.append(var)
+    lines.append("return " + " + ".join(assigned[:2]))
+    return ";".join(lines)
+
+
+def timeCall(func, repeat, minTime):
+    # Calibrate the loop count, then keep the best of `repeat` runs
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= minTime:
+            break
+        number *= 2
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def buildCases(quick=False):
+    rng = random.Random(SEED)
+    calc = Calculator()
+    cases = []
+
+    lengths = [4, 32] if quick else [4, 32, 256, 2048]
+    depths = [0, 4] if quick else [0, 4, 16, 64]
+    for length in lengths:
+        for depth in depths:
+            expr = genExpression(rng, length, depth)
+            params = {'length': length, 'depth': depth}
+            # Unoptimized, or the constant workloads would fold to a single number
+            program = Calculator.compile(expr, optimize=False)
+            calcObj = Calculator()
+            calcObj.setExpr(expr)
+            cases.append(("cleanExpr", params, lambda expr=expr: calc._cleanExpr(expr)))
+            cases.append(("isValidExpr", params, lambda expr=expr: calc._isValidExpr(expr)))
+            cases.append(("getPostfix", params, lambda expr=expr: calc._getPostfix(expr)))
+            cases.append(("evaluate", params, lambda program=program: program.evaluate()))
+            cases.append(("calculate", params, lambda calcObj=calcObj: calcObj.calculate))
+
+    statementCounts = [8, 64] if quick else [8, 64, 512]
+    variableCounts = [2, 16] if quick else [2, 16, 128]
+    for statements in statementCounts:
+        for variables in variableCounts:
+            adv = AdvancedCalculator()
+            adv.setExpression(genScript(rng, statements, variables))
+            params = {'statements': statements, 'variables': variables}
+            cases.append(("calculateExpressions", params, adv.calculateExpressions))
+
+    return cases
+
+
+def caseName(stage, params):
+    return stage + "[" + ",".join("{}={}".format(k, v) for k, v in sorted(params.items())) + "]"
+
+
+def run(quick=False, repeat=5, minTime=0.05, log=sys.stderr):
+    results = {}
+    for stage, params, func in buildCases(quick):
+        name = caseName(stage, params)
+        seconds = timeCall(func, repeat, minTime)
+        results[name] = {'stage': stage, 'params': params, 'seconds': seconds}
+        if log is not None:
+            log.write("{:<60} {:>12.3f} us\n".format(name, seconds * 1e6))
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'seed': SEED,
+            'repeat': repeat,
+            'quick': quick,
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold):
+    '''
+        Return (name, old, new, ratio) for every case slower than the baseline by
+        more than `threshold` (0.1 means 10%). Cases missing on either side are ignored.
+
+        >>> old = {'results': {'a': {'seconds': 1.0}, 'b': {'seconds': 1.0}}}
+        >>> new = {'results': {'a': {'seconds': 1.05}, 'b': {'seconds': 1.5}}}
+        >>> compare(old, new, 0.1)
+        [('b', 1.0, 1.5, 1.5)]
+    '''
+    regressions = []
+    for name, result in current['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        ratio = result['seconds'] / old['seconds']
+        if ratio > 1 + threshold:
+            regressions.append((name, old['seconds'], result['seconds'], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the calculator pipeline stage by stage.")
+    parser.add_argument("--output", help="write results as JSON to this file (default: stdout)")
+    parser.add_argument("--compare", metavar="BASELINE", help="flag regressions against a saved JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown before flagging (default 0.10)")
+    parser.add_argument("--repeat", type=int, default=5, help="timed repeats per case, best is kept (default 5)")
+    parser.add_argument("--quick", action="store_true", help="only run the smaller workloads")
+    args = parser.parse_args(argv)
+
+    current = run(args.quick, args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    elif not args.compare:
+        json.dump(current, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        for name, old, new, ratio in regressions:
+            print("REGRESSION {}: {:.3f} us -> {:.3f} us ({:+.1%})".format(name, old * 1e6, new * 1e6, ratio - 1))
+        if regressions:
+            return 1
+        print("No regressions over {:.0%} against {}".format(args.threshold, args.compare))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+'''
+    Bulk evaluation of large files of expressions, one per line, into a compact
+    binary result file that other tools can load without parsing.
+
+    Result file layout (all integers and floats little-endian):
+
+        magic      8 bytes   b"CALCBULK"
+        version    uint32    FORMAT_VERSION
+        reserved   uint32    0
+        count      uint64    number of input lines
+        values     count x float64, NaN where the line has no result
+        validity   ceil(count / 8) bytes, bit i (LSB first) set if line i has a result
+
+    With NumPy the result can be mapped directly:
+
+        values = numpy.memmap(path, numpy.float64, "r", HEADER.size, (count,))
+        bitmap = numpy.fromfile(path, numpy.uint8, offset=HEADER.size + 8 * count)
+        valid = numpy.unpackbits(bitmap, count=count, bitorder="little").astype(bool)
+'''
+import mmap
+import os
+import struct
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from cache import ParseCache
+from streaming import evaluateLine
+
+MAGIC = b"CALCBULK"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sIIQ")
+
+_NAN = float("nan")
+
+
+def evaluateFile(inputPath, outputPath, workers=None, chunksize=1 << 24):
+    '''
+        Evaluate every line of `inputPath` and write the results to `outputPath` in
+        the binary layout described above. The input is memory-mapped and cut into
+        chunks of about `chunksize` bytes on newline boundaries; chunks are evaluated
+        on a pool of `workers` processes (default: one per CPU) and written back in
+        input order. Lines are evaluated like the `eval` command: invalid input,
+        arithmetic errors and complex results are marked invalid. Returns the
+        number of lines.
+
+        >>> import os, tempfile
+        >>> folder = tempfile.mkdtemp()
+        >>> source, target = os.path.join(folder, 'in.txt'), os.path.join(folder, 'out.bin')
+        >>> with open(source, 'w') as f:
+        ...     _ = f.write('1 + 1\\n4 +\\n2 ^ 10\\n1 / 0\\nreturn 3 * 3\\n')
+        >>> evaluateFile(source, target, workers=1)
+        5
+        >>> values, valid = loadResults(target)
+        >>> [value if ok else None for value, ok in zip(values, valid)]
+        [2.0, None, 1024.0, None, 9.0]
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    with open(inputPath, "rb") as source:
+        size = os.fstat(source.fileno()).st_size
+        if size == 0:
+            chunks = []
+        else:
+            with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                chunks = _splitChunks(view, size, chunksize)
+
+    with open(outputPath, "wb") as output:
+        output.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, 0))
+        bitmap = bytearray()
+        # Validity bits that don't fill a whole byte yet, carried to the next chunk
+        carry = b""
+        count = 0
+        for values, validity in _evaluateChunks(inputPath, chunks, workers):
+            output.write(values)
+            count += len(validity)
+            bits = carry + validity
+            whole = len(bits) - len(bits) % 8
+            bitmap += _packBits(bits[:whole])
+            carry = bits[whole:]
+        bitmap += _packBits(carry)
+        output.write(bitmap)
+        output.seek(0)
+        output.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, count))
+    return count
+
+
+def loadResults(path):
+    '''
+        Read a result file written by evaluateFile with a single read. Returns the
+        values as an array('d') and the validity of each line as a list of bools.
+    '''
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, reserved, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("not a version {} result file".format(FORMAT_VERSION))
+
+    start = HEADER.size
+    values = array("d")
+    values.frombytes(data[start:start + 8 * count])
+    if sys.byteorder == "big":
+        values.byteswap()
+    bitmap = int.from_bytes(data[start + 8 * count:], "little")
+    # bin() puts bit 0 last, so reverse it to get one character per line
+    bits = bin(bitmap)[:1:-1].ljust(count, "0")
+    valid = [bit == "1" for bit in bits[:count]]
+    return values, valid
+
+
+def _splitChunks(view, size, chunksize):
+    # (start, end) byte ranges that each end just after a newline or at the end of file
+    chunks = []
+    start = 0
+    while start < size:
+        end = start + chunksize
+        if end >= size:
+            end = size
+        else:
+            newline = view.find(b"\n", end - 1)
+            end = size if newline < 0 else newline + 1
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+
+def _evaluateChunks(path, chunks, workers):
+    if workers <= 1 or len(chunks) <= 1:
+        cache = ParseCache()
+        for start, end in chunks:
+            yield _evaluateRange(path, start, end, cache)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+        # map() yields the chunks back in submission order
+        yield from pool.map(_evaluateRange, [path] * len(chunks), *zip(*chunks))
+
+
+def _evaluateRange(path, start, end, cache=None):
+    # Module level so it can be pickled and sent to worker processes.
+    # Returns the packed float64 values and one b"0"/b"1" byte per line.
+    if cache is None:
+        cache = ParseCache()
+    with open(path, "rb") as source:
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            lines = view[start:end].split(b"\n")
+    # A chunk ends with a newline unless it is the last one, so drop the empty tail
+    if lines[-1] == b"":
+        lines.pop()
+
+    values = array("d")
+    validity = bytearray()
+    for line in lines:
+        result = evaluateLine(line.decode("utf-8", "replace"), cache)
+        if result.__class__ is float:
+            values.append(result)
+            validity.append(49)
+        else:
+            values.append(_NAN)
+            validity.append(48)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes(), bytes(validity)
+
+
+def _packBits(bits):
+    # b"0"/b"1" bytes to a little-endian bitmap where bit i is bits[i]
+    if not bits:
+        return b""
+    return int(bits[::-1], 2).to_bytes((len(bits) + 7) // 8, "little")
@@ -0,0 +1,172 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+_MISSING = object()
+
+
+class ParseCache:
+    '''
+        Bounded LRU cache of compiled expressions keyed on the raw expression text.
+        Invalid expressions are cached as None so they are rejected without parsing again.
+        One cache can be shared by any number of Calculator and AdvancedCalculator
+        instances, including across threads.
+
+        >>> from calculator import Calculator
+        >>> cache = ParseCache(maxsize=2)
+        >>> calc = Calculator(cache)
+        >>> calc.setExpr('1 + 2')
+        >>> calc.calculate
+        3.0
+        >>> calc.calculate
+        3.0
+        >>> calc.setExpr('4 +')
+        >>> calc.calculate
+        >>> calc.setExpr('2 * 3')
+        >>> calc.calculate
+        6.0
+        >>> cache.stats()
+        {'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 3, 'evictions': 1}
+        >>> '1 + 2' in cache
+        False
+    '''
+    def __init__(self, maxsize=1024):
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def get(self, key, default=_MISSING):
+        '''
+            Return the cached value for `key` and mark it as recently used.
+            Returns `default` on a miss, or raises KeyError if no default was given.
+        '''
+        with self.__lock:
+            value = self.__entries.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.__entries.move_to_end(key)
+                return value
+        if default is _MISSING:
+            raise KeyError(key)
+        return default
+
+    def put(self, key, value):
+        with self.__lock:
+            entries = self.__entries
+            if key in entries:
+                entries.move_to_end(key)
+            entries[key] = value
+            # Evict the least recently used entries
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+                self.evictions += 1
+
+    def items(self):
+        # Snapshot of (key, value) pairs from least to most recently used
+        with self.__lock:
+            return list(self.__entries.items())
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self.__lock:
+            return {'size': len(self.__entries), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class ResultCache:
+    '''
+        Bounded LRU cache of script results with an optional time to live, keyed on
+        a script and its input bindings. A run is stored twice: under the script text,
+        so repeating it skips parsing as well as evaluation, and under the compiled
+        form, so scripts that only differ in formatting share results. Pass one as
+        `memo=` to AdvancedCalculator or runScript. Single expressions don't need
+        one: constants are folded at compile time, so a ParseCache already maps an
+        expression straight to its value.
+
+        >>> from advanced_calculator import runScript
+        >>> memo = ResultCache(maxsize=100, ttl=60)
+        >>> runScript('b = a * 2;return b + 1', {'a': 3.0}, memo=memo)
+        {'b = a * 2': {'a': 3.0, 'b': 6.0}, '_return_': 7.0}
+        >>> runScript('b = a*2 ;return b+1', {'a': 3.0}, memo=memo)
+        {'b = a*2 ': {'a': 3.0, 'b': 6.0}, '_return_': 7.0}
+        >>> runScript('b = a*2 ;return b+1', {'a': 3.0}, memo=memo)['_return_']
+        7.0
+        >>> memo.stats()
+        {'size': 3, 'maxsize': 100, 'ttl': 60, 'hits': 2, 'misses': 3, 'evictions': 0, 'expirations': 0}
+    '''
+    def __init__(self, maxsize=1024, ttl=None, clock=monotonic):
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive")
+        self.maxsize = maxsize
+        # Seconds an entry stays valid, or None to keep entries until they are evicted
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # key -> (value, expiry time or None)
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or self.clock() < expires:
+                    self.hits += 1
+                    self.__entries.move_to_end(key)
+                    return value
+                del self.__entries[key]
+                self.expirations += 1
+            self.misses += 1
+        return default
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        with self.__lock:
+            entries = self.__entries
+            if key in entries:
+                entries.move_to_end(key)
+            entries[key] = (value, expires)
+            # Evict the least recently used entries
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+
+    def stats(self):
+        with self.__lock:
+            return {'size': len(self.__entries), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'expirations': self.expirations}
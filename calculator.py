@@ -1,8 +1,204 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+from codegen import generateFunction
+from errors import ErrorResult, INVALID, ARGUMENT, ARITHMETIC
+from optimizer import foldConstants
 from stack import Stack
+from tokenizer import tokenize, InvalidExpression, LimitExceeded, NUMBER, OPERATOR, LPAREN, RPAREN, NEGATE, NAME
+
+# According to Order of Operations, * == / and + == -
+PRECEDENCE = {"^": 2, "*": 1, "/": 1, "+": 0, "-": 0}
+
+class Load:
+    '''
+        Postfix term that pushes the value of a variable. `key` is used to look the
+        value up in the mapping given to `CompiledExpr.evaluate`.
+
+        >>> Load('x1')
+        Load('x1')
+        >>> Load('x1') == Load('x1')
+        True
+    '''
+    __slots__ = ('name', 'key')
+
+    def __init__(self, name, key=None):
+        self.name = name
+        self.key = name if key is None else key
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return "Load({!r})".format(self.name)
+
+    def __eq__(self, other):
+        if not isinstance(other, Load):
+            return NotImplemented
+        return self.name == other.name and self.key == other.key
+
+    def __hash__(self):
+        return hash((self.name, self.key))
+
+
+class CompiledExpr:
+    '''
+        Immutable postfix program produced by `Calculator.compile`.
+        Operands are stored as floats, variables as `Load` terms and operators as
+        one character strings, so `evaluate` only has to run the stack machine.
+
+        >>> prog = Calculator.compile('2 * ( 3 + 4 )', optimize=False)
+        >>> prog
+        CompiledExpr('2.0 3.0 4.0 + *')
+        >>> prog.program
+        (2.0, 3.0, 4.0, '+', '*')
+        >>> prog.evaluate()
+        14.0
+        >>> prog.evaluate()
+        14.0
+        >>> prog.source
+        '2 * ( 3 + 4 )'
+        >>> prog.program = ()
+        Traceback (most recent call last):
+        ...
+        AttributeError: CompiledExpr is immutable
+        >>> prog = Calculator.compile('a * ( b + 2 ) - a', names=True)
+        >>> prog.variables
+        ('a', 'b')
+        >>> prog.evaluate({'a': 3.0, 'b': 4.0})
+        15.0
+    '''
+    __slots__ = ('program', 'source', 'variables')
+
+    def __init__(self, program, source=None):
+        program = tuple(program)
+        object.__setattr__(self, 'program', program)
+        object.__setattr__(self, 'source', source)
+        # Distinct variable names in order of first use
+        variables = {}
+        for term in program:
+            if term.__class__ is Load:
+                variables[term.name] = None
+        object.__setattr__(self, 'variables', tuple(variables))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('CompiledExpr is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('CompiledExpr is immutable')
+
+    def __reduce__(self):
+        # Pickle through the constructor, since attributes can't be set afterwards
+        return (CompiledExpr, (self.program, self.source))
+
+    def __str__(self):
+        return " ".join(str(term) for term in self.program)
+
+    def __repr__(self):
+        return "CompiledExpr({!r})".format(str(self))
+
+    def __eq__(self, other):
+        if not isinstance(other, CompiledExpr):
+            return NotImplemented
+        return self.program == other.program
+
+    def __hash__(self):
+        return hash(self.program)
+
+    def __len__(self):
+        return len(self.program)
+
+    def optimize(self):
+        '''
+            Return a copy with constant subexpressions folded and identity operations
+            such as `x * 1` removed. Results are unchanged.
+
+            >>> Calculator.compile('2 * ( 3 + 4 )', optimize=False).optimize()
+            CompiledExpr('14.0')
+        '''
+        return CompiledExpr(foldConstants(self.program), self.source)
+
+    def toFunction(self):
+        '''
+            Generate a native Python function for this program. It takes the values
+            of `variables` as positional arguments, in that order.
+
+            >>> f = Calculator.compile('a * ( b + 2 )', names=True).toFunction()
+            >>> f(3.0, 4.0)
+            18.0
+        '''
+        return generateFunction(self.program)
+
+    def resolve(self, symbols):
+        '''
+            Return a copy whose variables are looked up by slot instead of by name.
+            `symbols` maps every variable name to its index in the value list that
+            will be passed to `evaluate`.
+
+            >>> prog = Calculator.compile('b * ( a + 1 )', names=True).resolve({'a': 0, 'b': 1})
+            >>> prog.evaluate([2.0, 5.0])
+            15.0
+        '''
+        program = []
+        for term in self.program:
+            if term.__class__ is Load:
+                term = Load(term.name, symbols[term.name])
+            program.append(term)
+        return CompiledExpr(program, self.source)
+
+    def evaluate(self, variables=None, stack=None):
+        '''
+            Run the program. `variables` maps each Load key to its value, either a dict
+            keyed by name or a list indexed by slot after `resolve`. Values may be
+            anything supporting the arithmetic operators, such as NumPy arrays.
+            A `stack` can be passed in to be cleared and reused between evaluations.
+        '''
+        if stack is None:
+            calcStack = Stack()
+        else:
+            calcStack = stack
+            calcStack.clear()
+        push = calcStack.push
+        pop = calcStack.pop
+
+        for term in self.program:
+            # Operands were already parsed into floats at compile time
+            if term.__class__ is float:
+                push(term)
+            elif term.__class__ is Load:
+                push(variables[term.key])
+            else:
+                second = pop()
+                first = pop()
+                if term == "+":
+                    res = first + second
+                elif term == "-":
+                    res = first - second
+                elif term == "/":
+                    res = first / second
+                elif term == "*":
+                    res = first * second
+                elif term == "^":
+                    res = first ** second
+                push(res)
+
+        # Item left in stack is the result
+        return pop()
+
 
 class Calculator:
-    def __init__(self):
+    def __init__(self, cache=None, metrics=None, quiet=False):
         self.__expr = None
+        # Optional ParseCache shared with other calculators
+        self.cache = cache
+        # Optional Metrics registry, nothing is timed when it is None
+        self.metrics = metrics
+        # In quiet mode nothing is printed; the last failure is kept in `error` instead
+        self.quiet = quiet
+        self.error = None
+        # Reused by every call to calculate
+        self.__calcStack = Stack()
 
 
     @property
@@ -12,6 +208,10 @@ class Calculator:
     def setExpr(self, new_expr):
         if isinstance(new_expr, str):
             self.__expr=new_expr
+        elif self.quiet:
+            # Drop the previous expression so calculate can't return a stale value
+            self.__expr = None
+            self.error = ErrorResult(ARGUMENT, "expression must be a string")
         else:
             print('setExpr error: Invalid expression')
             return None
@@ -39,7 +239,8 @@ class Calculator:
 
     def _cleanExpr(self, expr:str):
         """
-        Clean an expression by removing trailing whitespaces and consequtive spacing
+        Clean an expression by removing trailing whitespaces and consequtive spacing.
+        Returns None if the expression is invalid.
 
         >>> calc = Calculator()
         >>> calc._cleanExpr(" 3    + 2 -   0 *    5    +  6")
@@ -56,42 +257,22 @@ class Calculator:
         '2.5 + 3 * ( 2 + ( 3.0 ) * ( 5 ^ 2 - 2 * 3 ^ ( 2 ) ) * ( 4 ) ) * ( 2 / 8 + 2 * ( 3 - 1 / 3 ) ) - 2 / 3 ^ 2'
         >>> calc._cleanExpr("7^2^3")
         '7 ^ 2 ^ 3'
+        >>> calc._cleanExpr("3 *  -(2)")
+        '3 * - ( 2 )'
+        >>> calc._cleanExpr("4 3 + 2")
         """
         if not isinstance(expr, str):
-            print("Invalid Expression")
+            if not self.quiet:
+                print("Invalid Expression")
             return None
 
-        allowed_ops = "+-*/^()"
-        # Split according to whitespace
-        expr = expr.split()
-        mutated = []
-
-        # Although expr was split, some operators may be conjoined to numbers
-        for sub in expr:
-            # Sub is not an operator and not a number... meaning it is a mix of both
-            # A negative number will not match this if statement
-            if not (self._isNumber(sub) and len(sub) > 1) or sub.startswith("+"):
-                # Loop through str
-                # Keep var that adds ch iteratively
-                # append on operator or end of str
-                term = ""
-                for ch in sub:
-                    # `ch in allowed_ops` --> Check if operator
-                    # `not (term == "" and ch == "-")` --> handles negative number
-                    if ch in allowed_ops and not (term == "" and ch == "-" and (mutated[-1] in allowed_ops[:-2])):
-                        if term != "":
-                            mutated.append(term)
-                        mutated.append(ch)
-                        term = ""
-                    else:
-                        if ch != " ":
-                            term += ch
-                if term != "":
-                    mutated.append(term)
-            else:
-                mutated.append(sub)
+        # The tokenizer splits operators from numbers and validates in a single pass
+        try:
+            tokens = tokenize(expr)
+        except InvalidExpression:
+            return None
 
-        return " ".join(mutated)
+        return " ".join([token.text for token in tokens])
 
 
     def _isValidExpr(self, expr):
@@ -125,51 +306,11 @@ class Calculator:
             #print(f"Invalid expression: {expr}, Not a str")
             return False
 
-        allowed_symbols = "+*/^.-() "
-        allowed_digits = "0123456789"
-
-        # Expression cannot start/end with an operator
-        if expr[0] in allowed_symbols[:-4] or expr[-1] in allowed_symbols[:-4]:
-            return False
-
-        # Don't allow unsupported operators
-        for ch in expr:
-            if ch not in allowed_digits + allowed_symbols:
-                return False
-
-        # Check if missing operands
-        last = 0
-        for ch in expr.split(" "): # The only way we would have missing operands would be if there is a space between 2 numbers
-            if self._isNumber(ch):
-                last += 1
-                if last > 1:
-                    return False
-            else:
-                last = 0
-
-        # Check for unmatched parenthesis
-        total = 0
-        for ch in expr:
-            if ch == "(":
-                total += 1
-            if ch == ")":
-                total -= 1
-        if total != 0:
+        try:
+            tokenize(expr)
+        except InvalidExpression:
             return False
 
-        expr = expr.replace(" ", "")
-        for i in range(len(expr)-1):
-            first = expr[i]
-            second = expr[i+1]
-            # Check for implied multiplication
-            if first == ")" and self._isNumber(second) or second == "(" and self._isNumber(first):
-                return False
-            if first == ")" and second == "(":
-                return False
-            # Check for consequtive operators
-            if first in allowed_symbols[:-3] and (second in allowed_symbols[:-3] and second != "-"):
-                return False
-
         return True
                 
 
@@ -207,6 +348,8 @@ class Calculator:
             '7.0 2.0 3.0 ^ ^'
             >>> x._getPostfix('7 * 2 + 3 + 6 * (3 * 2 + 5 ^ 2)')
             '7.0 2.0 * 3.0 + 6.0 3.0 2.0 * 5.0 2.0 ^ + * +'
+            >>> x._getPostfix('3 - -(2 + 1)')
+            '3.0 2.0 1.0 + -1.0 * -'
 
             # In invalid expressions, you might print an error message, adjust doctest accordingly
             # If you are veryfing the expression in calculate before passing to postfix, this cases are not necessary
@@ -220,39 +363,165 @@ class Calculator:
             >>> x._getPostfix('2 *      5% + 3       ^ + -2 +1 +4')
         '''
 
-        # Always double-check that the expression is cleaned.
-        eq = self._cleanExpr(txt)
-
-        if not self._isValidExpr(eq):
+        postfix_equation = self._postfixTerms(txt)
+        if postfix_equation is None:
             return None
+        return " ".join(str(term) for term in postfix_equation)
+
+
+    def _postfixTerms(self, txt, names=False, metrics=None, limits=None, tokens=None):
+        # Same as _getPostfix, but operands are kept as floats in a list so
+        # callers don't have to split and parse the postfix string again.
+        # Cleaning and validation happen while tokenizing, unless the caller
+        # already has the tokens
+        if metrics is not None:
+            start = perf_counter()
+        if tokens is None:
+            try:
+                if limits is None:
+                    tokens = tokenize(txt, names)
+                else:
+                    tokens = tokenize(txt, names, limits.maxTokens, limits.maxDepth)
+            except LimitExceeded:
+                # Guarded callers want to know which limit was hit
+                raise
+            except InvalidExpression:
+                if metrics is not None:
+                    metrics.record("tokenize", perf_counter() - start)
+                    metrics.increment("invalidExpressions")
+                return None
+            if metrics is not None:
+                now = perf_counter()
+                metrics.record("tokenize", now - start)
+                metrics.increment("tokens", len(tokens))
+                start = now
 
         postfixStack = Stack()  # method must use postfixStack to compute the postfix expression
-        # Keep items neat in a list and concatenate at the end
+        # Keep items neat in a list
         postfix_equation = []
-        # Split up operands & operators and iterate
-        for term in eq.split():
-            # ')' signifies that stack must be popped
-            if term == ")":
-                while not postfixStack.isEmpty() and postfixStack.peek() != "(":
-                    postfix_equation.append(postfixStack.pop())
-                postfixStack.pop()
-            elif term == "(":
-                postfixStack.push(term)
-            elif term in "*-+/^":
+        for token in tokens:
+            kind = token.kind
+            if kind is NUMBER:
+                # All operands are directly added to equation
+                postfix_equation.append(token.value)
+            elif kind is OPERATOR:
+                term = token.value
                 # If term in stack has a higher precedence, append all higher precedence items in stack first
-                # According to Order of Operations, * == / and + == -
-                precedence = {"^": 2, "*": 1, "/": 1, "+": 0, "-": 0}
-                # `term != "^"` was implemented to pass exponent tests like '7^2^3'... not sure if this is a proper solution, but seems to work in more than one case.
-                while postfixStack.peek() != "(" and not postfixStack.isEmpty() and (precedence[postfixStack.peek()] >= precedence[term] and term != "^"):
+                # `term != "^"` keeps exponents right associative, e.g. '7^2^3'
+                while postfixStack.peek() != "(" and not postfixStack.isEmpty() and (PRECEDENCE[postfixStack.peek()] >= PRECEDENCE[term] and term != "^"):
                     postfix_equation.append(postfixStack.pop())
                 postfixStack.push(term)
+            elif kind is NAME:
+                postfix_equation.append(Load(token.value))
+                # A unary minus in front of a variable negates it
+                if postfixStack.peek() is NEGATE:
+                    postfixStack.pop()
+                    postfix_equation.append(-1.0)
+                    postfix_equation.append("*")
+            elif kind is LPAREN:
+                postfixStack.push("(")
+            elif kind is RPAREN:
+                # ')' signifies that stack must be popped
+                while postfixStack.peek() != "(":
+                    postfix_equation.append(postfixStack.pop())
+                postfixStack.pop()
+                # A unary minus in front of the parenthesis negates the whole group
+                if postfixStack.peek() is NEGATE:
+                    postfixStack.pop()
+                    postfix_equation.append(-1.0)
+                    postfix_equation.append("*")
             else:
-                # All operands are directly added to equation
-                postfix_equation.append(str(float(term)))
+                # NEGATE is always followed by '(' or a variable and stays below '(' in the stack
+                postfixStack.push(NEGATE)
         while not postfixStack.isEmpty():
             postfix_equation.append(postfixStack.pop())
 
-        return " ".join(postfix_equation)
+        if metrics is not None:
+            metrics.record("postfix", perf_counter() - start)
+        return postfix_equation
+
+
+    @classmethod
+    def compile(cls, expr, cache=None, names=False, metrics=None, optimize=True, limits=None, tokens=None):
+        '''
+            Parse `expr` once and return an immutable `CompiledExpr`, or None if
+            the expression is invalid. Evaluating the result skips all text processing.
+            When a ParseCache is given, repeated expressions are not parsed again.
+            With `names` set, variables are allowed and compiled to `Load` terms.
+            Parsing phases are recorded in `metrics` when one is given.
+            Unless `optimize` is False, constant subexpressions are folded.
+            With `limits` (see guard.Limits), parsing stops with LimitExceeded once the
+            token count or nesting depth is too large; cached programs are not rechecked.
+            Callers that already tokenized `expr` can pass the `tokens` to skip that step.
+
+            >>> prog = Calculator.compile('7^2^3', optimize=False)
+            >>> prog.program
+            (7.0, 2.0, 3.0, '^', '^')
+            >>> prog.evaluate()
+            5764801.0
+            >>> Calculator.compile('x * ( 7^2 - 1 )', names=True)
+            CompiledExpr('x 48.0 *')
+            >>> Calculator.compile('( 2 ) * 10 - 3 * / ( 2 - 3 * 2 )')
+            >>> Calculator.compile(42)
+        '''
+        if not isinstance(expr, str) or len(expr) <= 0:
+            return None
+
+        # Expressions with variables are a different language, so they get their own key
+        key = ("names", expr) if names else expr
+        if not optimize:
+            key = ("unoptimized", key)
+        if cache is not None:
+            # Invalid expressions are cached as None, so use False to detect a miss
+            program = cache.get(key, False)
+            if program is not False:
+                return program
+
+        terms = cls()._postfixTerms(expr, names, metrics, limits, tokens)
+        if terms is not None and optimize:
+            if metrics is not None:
+                start = perf_counter()
+            terms = foldConstants(terms)
+            if metrics is not None:
+                metrics.record("optimize", perf_counter() - start)
+        program = None if terms is None else CompiledExpr(terms, expr)
+        if cache is not None:
+            cache.put(key, program)
+        return program
+
+
+    @classmethod
+    def evaluateMany(cls, exprs, workers=None, chunksize=1000, cache=None, errors=False):
+        '''
+            Evaluate a list of expressions and return their results in input order.
+            Invalid expressions and arithmetic errors such as division by zero give None,
+            so one bad entry can't abort the batch. The input is split into chunks of
+            `chunksize` that are evaluated on a pool of `workers` processes
+            (default: one per CPU); batches that fit in one chunk, or `workers=1`,
+            are evaluated serially in this process using `cache`. With `errors` set,
+            failures give an ErrorResult with the reason instead of None.
+
+            >>> Calculator.evaluateMany(['1 + 2', '4 +', '2 ^ 3', 7, '1 / 0'])
+            [3.0, None, 8.0, None, None]
+            >>> Calculator.evaluateMany(['4 +', '1 / 0'], errors=True)
+            [ErrorResult('invalid', 'expression cannot end with an operator', 2), ErrorResult('arithmetic', 'float division by zero', None)]
+            >>> Calculator.evaluateMany(['2 * %d' % i for i in range(6)], workers=2, chunksize=2)
+            [0.0, 2.0, 4.0, 6.0, 8.0, 10.0]
+        '''
+        exprs = list(exprs)
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        if workers <= 1 or len(exprs) <= chunksize:
+            return _evaluateChunk(exprs, cache, errors)
+
+        chunks = [exprs[i:i + chunksize] for i in range(0, len(exprs), chunksize)]
+        results = []
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+            # map() yields the chunks back in submission order
+            for chunk in pool.map(_evaluateChunk, chunks, [None] * len(chunks), [errors] * len(chunks)):
+                results.extend(chunk)
+        return results
 
 
     @property
@@ -314,183 +583,110 @@ class Calculator:
             >>> x.calculate
             >>> x.setExpr("( -2/6) + ( 5 ( ( 9.4 )))") 
             >>> x.calculate
+
+            # In quiet mode nothing is printed and the reason is kept in `error`
+            >>> q=Calculator(quiet=True)
+            >>> q.setExpr('3 ( 5)')
+            >>> q.calculate
+            >>> q.error
+            ErrorResult('invalid', 'implied multiplication', 2)
+            >>> q.calculate
+            >>> q.setExpr('1 + 1')
+            >>> q.setExpr(42)
+            >>> q.calculate
+            >>> q.error
+            ErrorResult('argument', 'expression must be a non-empty string', None)
         '''
 
+        if self.quiet:
+            result = evaluateOrError(self.__expr, self.cache, self.metrics, self.__calcStack)
+            if result.__class__ is ErrorResult:
+                self.error = result
+                return None
+            self.error = None
+            return result
+
         if not isinstance(self.__expr,str) or len(self.__expr)<=0:
             print("Argument error in calculate")
             return None
 
-        calcStack = Stack()   # method must use calcStack to compute the  expression
-
-
-        postfix = self._getPostfix(self.__expr)
-        # `postfix` would only be `None` if the expression is invalid
-        if postfix == None:
-            return None
-
-        for term in postfix.split():
-            # When encountering an operand, push it into the stack
-            if term not in "+-^*/":
-                calcStack.push(float(term)) # All terms are str type
-            # When encountering an operator, perform a calculation
-            else:
-                second = calcStack.pop()
-                first = calcStack.pop()
-                if term == "+":
-                    res = first + second
-                elif term == "-":
-                    res = first - second
-                elif term == "/":
-                    res = first / second
-                elif term == "*":
-                    res = first * second
-                elif term == "^":
-                    res = first ** second
-                # Push calculation back into stack
-                calcStack.push(res)
-
-        # Item left in stack is the result
-        return calcStack.pop()
+        # The instance only holds the expression; the work is done by evaluate()
+        return evaluate(self.__expr, self.cache, self.metrics, self.__calcStack)
             
 
-class AdvancedCalculator:
+def evaluate(expr, cache=None, metrics=None, stack=None):
     '''
-        >>> C = AdvancedCalculator()
-        >>> C.states == {}
-        True
-        >>> C.setExpression('a = 5;b = 7 + a;a = 7;c = a + b;c = a * 0;return c')
-        >>> C.calculateExpressions() == {'a = 5': {'a': 5.0}, 'b = 7 + a': {'a': 5.0, 'b': 12.0}, 'a = 7': {'a': 7.0, 'b': 12.0}, 'c = a + b': {'a': 7.0, 'b': 12.0, 'c': 19.0}, 'c = a * 0': {'a': 7.0, 'b': 12.0, 'c': 0.0}, '_return_': 0.0}
-        True
-        >>> C.states == {'a': 7.0, 'b': 12.0, 'c': 0.0}
-        True
-        >>> C.setExpression('x1 = 5;x2 = 7 * ( x1 - 1 );x1 = x2 - x1;return x2 + x1 ^ 3')
-        >>> C.states == {}
-        True
-        >>> C.calculateExpressions() == {'x1 = 5': {'x1': 5.0}, 'x2 = 7 * ( x1 - 1 )': {'x1': 5.0, 'x2': 28.0}, 'x1 = x2 - x1': {'x1': 23.0, 'x2': 28.0}, '_return_': 12195.0}
-        True
-        >>> print(C.calculateExpressions())
-        {'x1 = 5': {'x1': 5.0}, 'x2 = 7 * ( x1 - 1 )': {'x1': 5.0, 'x2': 28.0}, 'x1 = x2 - x1': {'x1': 23.0, 'x2': 28.0}, '_return_': 12195.0}
-        >>> C.states == {'x1': 23.0, 'x2': 28.0}
-        True
-        >>> C.setExpression('x1 = 5 * 5 + 97;x2 = 7 * ( x1 / 2 );x1 = x2 * 7 / x1;return x1 * ( x2 - 5 )')
-        >>> C.calculateExpressions() == {'x1 = 5 * 5 + 97': {'x1': 122.0}, 'x2 = 7 * ( x1 / 2 )': {'x1': 122.0, 'x2': 427.0}, 'x1 = x2 * 7 / x1': {'x1': 24.5, 'x2': 427.0}, '_return_': 10339.0}
-        True
-        >>> C.states == {'x1': 24.5, 'x2': 427.0}
-        True
-        >>> C.setExpression('A = 1;B = A + 9;C = A + B;A = 20;D = A + B + C;return D - A')
-        >>> C.calculateExpressions() == {'A = 1': {'A': 1.0}, 'B = A + 9': {'A': 1.0, 'B': 10.0}, 'C = A + B': {'A': 1.0, 'B': 10.0, 'C': 11.0}, 'A = 20': {'A': 20.0, 'B': 10.0, 'C': 11.0}, 'D = A + B + C': {'A': 20.0, 'B': 10.0, 'C': 11.0, 'D': 41.0}, '_return_': 21.0}
-        True
-        >>> C.states == {'A': 20.0, 'B': 10.0, 'C': 11.0, 'D': 41.0}
-        True
-        >>> C.setExpression('A = 1;B = A + 9;2C = A + B;A = 20;D = A + B + C;return D + A')
-        >>> C.calculateExpressions() is None
-        True
-        >>> C.states == {}
-        True
+        Stateless version of Calculator.calculate: return the value of `expr`, or None
+        if it is invalid. Nothing is shared between calls apart from the optional
+        ParseCache and Metrics, which are locked, so it can be called from many
+        threads at once. A `stack` is only reused when the caller owns it.
+
+        >>> evaluate('2 * ( 3 + 4 )')
+        14.0
+        >>> evaluate('4 ++ 3')
+        >>> evaluate(None)
     '''
-    def __init__(self):
-        self.expressions = ''
-        self.states = {}
-
-    def setExpression(self, expression):
-        self.expressions = expression
-        self.states = {}
-
-    def _isVariable(self, word):
-        '''
-            >>> C = AdvancedCalculator()
-            >>> C._isVariable('volume')
-            True
-            >>> C._isVariable('4volume')
-            False
-            >>> C._isVariable('volume2')
-            True
-            >>> C._isVariable('vol%2')
-            False
-        '''
-
-        if not isinstance(word, str):
-            return False
-
-        # Variables must start with a letter
-        if not word[0].isalpha():
-            return False
-
-        # Variables can only contain alphanumeric characters
-        for ch in word:
-            if not ch.isalnum():
-                return False
-        
-        return True
-
-
-    def _replaceVariables(self, expr):
-        '''
-            >>> C = AdvancedCalculator()
-            >>> C.states = {'x1': 23.0, 'x2': 28.0}
-            >>> C._replaceVariables('1')
-            '1'
-            >>> C._replaceVariables('105 + x')
-            >>> C._replaceVariables('7 * ( x1 - 1 )')
-            '7 * ( 23.0 - 1 )'
-            >>> C._replaceVariables('x2 - x1')
-            '28.0 - 23.0'
-        '''
-
-        replaced = expr
-        for var in self.states:
-            # Only attempt replacement if `var` is a variable
-            if self._isVariable(var):
-                replaced = replaced.replace(var, str(self.states[var]))
-
-        for term in replaced.split(" "):
-            if self._isVariable(term):
-                return None
+    program = Calculator.compile(expr, cache, metrics=metrics)
+    # `program` would only be `None` if the expression is invalid
+    if program is None:
+        return None
 
-        return replaced
+    if metrics is None:
+        return program.evaluate(stack=stack)
+    start = perf_counter()
+    result = program.evaluate(stack=stack)
+    metrics.record("evaluate", perf_counter() - start)
+    return result
 
-    
-    def calculateExpressions(self):
-        self.states = {} 
-        calcObj = Calculator()     # method must use calcObj to compute each expression
 
-        steps = {}
-        exprs = self.expressions.split(";")
-        final_eq = exprs.pop()[7:]
-
-        # Iterate over each expression that is setting a variable and add to state
+def evaluateOrError(expr, cache=None, metrics=None, stack=None):
+    '''
+        Like evaluate, but never prints or raises: failures return an ErrorResult
+        with an error code, the reason and, for invalid expressions, the position.
+        The reason is only worked out once an expression has failed, so valid input
+        costs the same as with evaluate.
+
+        >>> evaluateOrError('2 * ( 3 + 4 )')
+        14.0
+        >>> evaluateOrError('2 * 5%')
+        ErrorResult('invalid', "unsupported character '%'", 5)
+        >>> evaluateOrError('1 / ( 2 - 2 )')
+        ErrorResult('arithmetic', 'float division by zero', None)
+        >>> evaluateOrError(42)
+        ErrorResult('argument', 'expression must be a non-empty string', None)
+    '''
+    if not isinstance(expr, str) or len(expr) <= 0:
+        return ErrorResult(ARGUMENT, "expression must be a non-empty string")
+    try:
+        result = evaluate(expr, cache, metrics, stack)
+    except ArithmeticError as error:
+        return ErrorResult(ARITHMETIC, str(error))
+    if result is not None:
+        return result
+
+    # Tokenizing again gives the position and reason of the first error
+    try:
+        tokenize(expr)
+    except InvalidExpression as error:
+        return ErrorResult(INVALID, error.reason, error.position)
+    return ErrorResult(INVALID, "invalid expression")
+
+
+def _evaluateChunk(exprs, cache=None, errors=False):
+    # Module level so it can be pickled and sent to worker processes
+    results = []
+    if errors:
         for expr in exprs:
-            split_expr = expr.split("=")
-            var = split_expr[0].strip()
-            var_equals = split_expr[-1].strip()
-            replaced = self._replaceVariables(var_equals)
-            # Return None if variables are not defined
-            if replaced is None:
-                self.states = {}
-                return None
-            calcObj.setExpr(replaced)
-            self.states[var] = calcObj.calculate
-
-            # Create a new dict in memory to store the state of current step
-            current_state = {}
-            for key, value in self.states.items():
-                current_state[key] = value
-            steps[expr] = current_state
-
-        # Replace variables in final expression and calculate
-        final = self._replaceVariables(final_eq)
-        calcObj.setExpr(final)
-        calculation = calcObj.calculate
-        # `calculation` returns None if there is an invalid expression
-        if calculation is None:
-            self.states = {}
-            return None
-        else:
-            steps["_return_"] = calcObj.calculate
-            return steps
-            
+            results.append(evaluateOrError(expr, cache))
+        return results
+    for expr in exprs:
+        try:
+            results.append(evaluate(expr, cache))
+        except ArithmeticError:
+            results.append(None)
+    return results
+
 
 if __name__ == "__main__":
     import doctest
-    #doctest.run_docstring_examples(AdvancedCalculator, globals(), verbose=False)
     doctest.testmod(verbose=True)
\ No newline at end of file
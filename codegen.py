@@ -0,0 +1,73 @@
+OPERATORS = {"+": "+", "-": "-", "*": "*", "/": "/", "^": "**"}
+
+
+def generateSource(program):
+    '''
+        Translate a postfix program into the source of a straight-line Python function.
+        Only generated identifiers and the whitelisted operators reach the source:
+        constants are passed in as `_k0, _k1, ...` and variables as the positional
+        arguments `_a0, _a1, ...` in the order of `variables`, so no user text is ever
+        compiled. Returns (source, constants, variables).
+
+        >>> from calculator import Calculator
+        >>> source, constants, variables = generateSource(Calculator.compile('a * ( b + 2 ) ^ a', names=True).program)
+        >>> print(source)
+        def _compiled(_a0, _a1):
+            _t0 = _a1 + _k0
+            _t1 = _t0 ** _a0
+            _t2 = _a0 * _t1
+            return _t2
+        >>> constants, variables
+        ((2.0,), ('a', 'b'))
+    '''
+    constants = []
+    variables = {}
+    lines = []
+    stack = []
+    for term in program:
+        if term.__class__ is float:
+            stack.append("_k{}".format(len(constants)))
+            constants.append(term)
+        elif term.__class__ is str:
+            if term not in OPERATORS:
+                raise ValueError("unsupported operator {!r}".format(term))
+            second = stack.pop()
+            first = stack.pop()
+            temp = "_t{}".format(len(lines))
+            lines.append("    {} = {} {} {}".format(temp, first, OPERATORS[term], second))
+            stack.append(temp)
+        else:
+            # Variable loads become positional arguments, numbered by first use
+            index = variables.setdefault(term.name, len(variables))
+            stack.append("_a{}".format(index))
+
+    if len(stack) != 1:
+        raise ValueError("malformed postfix program")
+    args = ", ".join("_a{}".format(i) for i in range(len(variables)))
+    lines.insert(0, "def _compiled({}):".format(args))
+    lines.append("    return {}".format(stack[0]))
+    return "\n".join(lines), tuple(constants), tuple(variables)
+
+
+def generateFunction(program):
+    '''
+        Compile a postfix program into a plain Python function that takes the values
+        of its variables as positional arguments, in the order of its `variables`
+        attribute, and runs at the speed of ordinary Python arithmetic.
+
+        >>> from calculator import Calculator
+        >>> f = generateFunction(Calculator.compile('x2 - x1 ^ 2', names=True).program)
+        >>> f.variables
+        ('x2', 'x1')
+        >>> f(28.0, 3.0)
+        19.0
+    '''
+    source, constants, variables = generateSource(program)
+    # No builtins are available to the generated code
+    namespace = {"__builtins__": {}}
+    for i, constant in enumerate(constants):
+        namespace["_k{}".format(i)] = constant
+    exec(compile(source, "<calculator>", "exec"), namespace)
+    function = namespace["_compiled"]
+    function.variables = variables
+    return function
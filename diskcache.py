@@ -0,0 +1,183 @@
+'''
+    Persistent on-disk copy of a ParseCache, so short-lived processes can start with
+    every expression and script already compiled.
+
+    The file is a small header followed by one marshal blob:
+
+        magic      8 bytes   b"CALCPRG1"
+        version    uint32    FORMAT_VERSION
+        tag        16 bytes  interpreter cache tag, e.g. b"cpython-311"
+        entries    marshal list of (key, digest, payload), least recently used first
+
+    Each payload is the entry's compiled form, marshalled on its own, and its
+    digest is a hash of the format version, the key and the payload bytes. Entries
+    whose digest doesn't match, e.g. because the payload was damaged, are skipped
+    when loading. Bump
+    FORMAT_VERSION whenever the compiled form changes; files written with another
+    version or by another interpreter are ignored as a whole.
+'''
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+import sys
+
+from advanced_calculator import CompiledScript
+from cache import ParseCache
+from calculator import CompiledExpr, Load
+from optimizer import SharedScript
+
+MAGIC = b"CALCPRG1"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<8sI16s")
+_TAG = (sys.implementation.cache_tag or sys.implementation.name).encode()[:16]
+
+
+def saveCache(cache, path):
+    '''
+        Write every entry of `cache` to `path`. The file is replaced atomically, so
+        processes loading it concurrently never see a partial write. Returns the
+        number of entries written.
+
+        >>> import os, tempfile
+        >>> from calculator import Calculator
+        >>> path = os.path.join(tempfile.mkdtemp(), 'programs.bin')
+        >>> cache = ParseCache()
+        >>> _ = Calculator.compile('x * ( 2 + 3 )', cache, names=True)
+        >>> _ = Calculator.compile('4 +', cache)
+        >>> saveCache(cache, path)
+        2
+        >>> warm = loadCache(path)
+        >>> warm.get(('names', 'x * ( 2 + 3 )'))
+        CompiledExpr('x 5.0 *')
+        >>> warm.get('4 +', False) is None
+        True
+
+        A damaged entry is skipped rather than loaded:
+
+        >>> with open(path, 'rb') as f:
+        ...     data = bytearray(f.read())
+        >>> data[data.rindex(b'x * ( 2 + 3 )')] = ord('y')     # the source kept in the payload
+        >>> with open(path, 'wb') as f:
+        ...     _ = f.write(data)
+        >>> damaged = loadCache(path)
+        >>> damaged.get(('names', 'x * ( 2 + 3 )'), False)
+        False
+        >>> damaged.get('4 +', False) is None
+        True
+    '''
+    entries = []
+    for key, value in cache.items():
+        payload = marshal.dumps(_encode(value))
+        entries.append((key, _digest(key, payload), payload))
+
+    data = HEADER.pack(MAGIC, FORMAT_VERSION, _TAG) + marshal.dumps(entries)
+    temp = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp, "wb") as f:
+        f.write(data)
+    os.replace(temp, path)
+    return len(entries)
+
+
+def loadCache(path, cache=None):
+    '''
+        Load the entries saved in `path` into `cache` (a new ParseCache by default)
+        and return it. The file is memory-mapped and decoded in one pass. A missing,
+        corrupt or incompatible file leaves the cache empty rather than failing, so
+        a worker can always start, just without a warm cache.
+    '''
+    if cache is None:
+        cache = ParseCache()
+    entries = _readEntries(path)
+    if entries is None:
+        return cache
+
+    loads = {}
+    for key, digest, payload in entries:
+        try:
+            if digest != _digest(key, payload):
+                continue
+            value = _decode(marshal.loads(payload), loads)
+        except (TypeError, ValueError, IndexError, EOFError):
+            continue
+        cache.put(key, value)
+    return cache
+
+
+def _readEntries(path):
+    try:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                if len(view) < HEADER.size:
+                    return None
+                magic, version, tag = HEADER.unpack_from(view)
+                if magic != MAGIC or version != FORMAT_VERSION or tag.rstrip(b"\0") != _TAG:
+                    return None
+                with memoryview(view)[HEADER.size:] as data:
+                    entries = marshal.loads(data)
+    except (OSError, ValueError, EOFError, TypeError):
+        # Missing or empty files, and truncated or corrupt data
+        return None
+    return entries if isinstance(entries, list) else None
+
+
+def _digest(key, payload):
+    # Keys hold the source text, e.g. "1 + 2", ("names", text) or ("script", text, inputs)
+    digest = hashlib.blake2b("{}\0{!r}\0".format(FORMAT_VERSION, key).encode("utf-8", "surrogatepass"),
+                             digest_size=16)
+    digest.update(payload)
+    return digest.digest()
+
+
+def _encodeProgram(program):
+    # Load terms become (name, key) tuples; floats and operators are kept as they are
+    terms = []
+    for term in program.program:
+        if term.__class__ is Load:
+            terms.append((term.name, term.key))
+        else:
+            terms.append(term)
+    return tuple(terms), program.source
+
+
+def _decodeProgram(encoded, loads):
+    # `loads` shares one Load per (name, key) between all programs in the file
+    terms, source = encoded
+    program = []
+    for term in terms:
+        if term.__class__ is tuple:
+            load = loads.get(term)
+            if load is None:
+                load = loads[term] = Load(*term)
+            term = load
+        program.append(term)
+    return CompiledExpr(program, source)
+
+
+def _encode(value):
+    if value is None:
+        return None
+    if isinstance(value, CompiledExpr):
+        return ("expr", _encodeProgram(value))
+    if isinstance(value, CompiledScript):
+        statements = tuple((expr, var, slot, _encodeProgram(program))
+                           for expr, var, slot, program in value.statements)
+        return ("script", statements, _encodeProgram(value.result), value.symbols, value.source)
+    if isinstance(value, SharedScript):
+        return ("shared", value.inputs, value.constants, value.operations, value.statements, value.result)
+    raise TypeError("cannot save {!r}".format(type(value).__name__))
+
+
+def _decode(payload, loads):
+    if payload is None:
+        return None
+    if payload[0] == "expr":
+        return _decodeProgram(payload[1], loads)
+    if payload[0] == "script":
+        kind, statements, result, symbols, source = payload
+        statements = [(expr, var, slot, _decodeProgram(program, loads)) for expr, var, slot, program in statements]
+        return CompiledScript(statements, _decodeProgram(result, loads), symbols, source)
+    if payload[0] == "shared":
+        return SharedScript(*payload[1:])
+    raise ValueError("unknown entry {!r}".format(payload[0]))
@@ -0,0 +1,45 @@
+from collections import Counter
+
+# Error codes
+INVALID = "invalid"          # the text is not a valid expression
+ARGUMENT = "argument"        # the input is not a non-empty string
+ARITHMETIC = "arithmetic"    # evaluation raised, e.g. division by zero
+
+
+class ErrorResult:
+    '''
+        Lightweight error returned in place of a value by the quiet evaluation
+        functions. `code` is one of INVALID, ARGUMENT or ARITHMETIC, `reason`
+        describes the problem and `position` is the character offset of invalid
+        input, or None.
+
+        >>> ErrorResult(INVALID, "missing operator", 2)
+        ErrorResult('invalid', 'missing operator', 2)
+    '''
+    __slots__ = ('code', 'reason', 'position')
+
+    def __init__(self, code, reason, position=None):
+        self.code = code
+        self.reason = reason
+        self.position = position
+
+    def __repr__(self):
+        return "ErrorResult({!r}, {!r}, {!r})".format(self.code, self.reason, self.position)
+
+    def __eq__(self, other):
+        if not isinstance(other, ErrorResult):
+            return NotImplemented
+        return (self.code, self.reason, self.position) == (other.code, other.reason, other.position)
+
+    def __hash__(self):
+        return hash((self.code, self.reason, self.position))
+
+
+def summarizeErrors(results):
+    '''
+        Count the errors in a list of results by (code, reason); values are skipped.
+
+        >>> summarizeErrors([1.0, ErrorResult(INVALID, "missing operand", 3), ErrorResult(INVALID, "missing operand", 5), None])
+        Counter({('invalid', 'missing operand'): 2})
+    '''
+    return Counter((result.code, result.reason) for result in results if result.__class__ is ErrorResult)
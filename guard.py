@@ -0,0 +1,114 @@
+from time import perf_counter
+
+from calculator import Calculator
+from stack import Stack
+from tokenizer import LimitExceeded
+
+# How many operations run between two checks of the time budget
+_CLOCK_INTERVAL = 1024
+
+
+class Limits:
+    '''
+        Bounds for guardedEvaluate. Any limit can be set to None to disable it.
+
+        - maxTokens: tokens in the expression, checked while tokenizing
+        - maxDepth: parenthesis nesting, checked while tokenizing
+        - maxOperations: operators in the compiled program, checked before evaluating
+        - maxMagnitude: largest absolute value of a constant or intermediate result
+        - timeBudget: seconds for the whole call, parsing included
+    '''
+    __slots__ = ('maxTokens', 'maxDepth', 'maxOperations', 'maxMagnitude', 'timeBudget')
+
+    def __init__(self, maxTokens=10000, maxDepth=100, maxOperations=10000, maxMagnitude=1e300, timeBudget=None):
+        self.maxTokens = maxTokens
+        self.maxDepth = maxDepth
+        self.maxOperations = maxOperations
+        self.maxMagnitude = maxMagnitude
+        self.timeBudget = timeBudget
+
+    def __repr__(self):
+        return "Limits({})".format(", ".join("{}={!r}".format(name, getattr(self, name)) for name in self.__slots__))
+
+
+def guardedEvaluate(expr, limits=None, cache=None):
+    '''
+        Evaluate `expr` like calculator.evaluate, but reject inputs that are too
+        expensive with a LimitExceeded error naming the limit instead of running
+        them. Size limits are checked before any arithmetic happens, and constants
+        are not folded at compile time, so every operation is counted and checked.
+        Invalid expressions still return None and division by zero still raises.
+
+        >>> guardedEvaluate('2 * ( 3 + 4 )')
+        14.0
+        >>> guardedEvaluate('9 ^ 9 ^ 9')
+        Traceback (most recent call last):
+        ...
+        tokenizer.LimitExceeded: magnitude limit of 1e+300 exceeded
+        >>> guardedEvaluate('(((1)))', Limits(maxDepth=2))
+        Traceback (most recent call last):
+        ...
+        tokenizer.LimitExceeded: depth limit of 2 exceeded at position 2
+        >>> guardedEvaluate(' + '.join(['1'] * 10), Limits(maxOperations=5))
+        Traceback (most recent call last):
+        ...
+        tokenizer.LimitExceeded: operations limit of 5 exceeded
+        >>> guardedEvaluate('1 +')
+    '''
+    if limits is None:
+        limits = Limits()
+    timeBudget = limits.timeBudget
+    deadline = None if timeBudget is None else perf_counter() + timeBudget
+
+    program = Calculator.compile(expr, cache, optimize=False, limits=limits)
+    if program is None:
+        return None
+    if deadline is not None and perf_counter() > deadline:
+        raise LimitExceeded("time", timeBudget)
+
+    # Constants are checked up front: a long enough literal parses to inf
+    maxMagnitude = limits.maxMagnitude
+    operations = 0
+    for term in program.program:
+        if term.__class__ is str:
+            operations += 1
+        elif maxMagnitude is not None and abs(term) > maxMagnitude:
+            raise LimitExceeded("magnitude", maxMagnitude)
+    if limits.maxOperations is not None and operations > limits.maxOperations:
+        raise LimitExceeded("operations", limits.maxOperations)
+
+    calcStack = Stack()
+    push = calcStack.push
+    pop = calcStack.pop
+    count = 0
+    for term in program.program:
+        if term.__class__ is not str:
+            push(term)
+            continue
+
+        second = pop()
+        first = pop()
+        try:
+            if term == "+":
+                res = first + second
+            elif term == "-":
+                res = first - second
+            elif term == "/":
+                res = first / second
+            elif term == "*":
+                res = first * second
+            else:
+                res = first ** second
+        except OverflowError:
+            if maxMagnitude is None:
+                raise
+            raise LimitExceeded("magnitude", maxMagnitude) from None
+        if maxMagnitude is not None and abs(res) > maxMagnitude:
+            raise LimitExceeded("magnitude", maxMagnitude)
+        push(res)
+
+        count += 1
+        if deadline is not None and count % _CLOCK_INTERVAL == 0 and perf_counter() > deadline:
+            raise LimitExceeded("time", timeBudget)
+
+    return pop()
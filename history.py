@@ -0,0 +1,135 @@
+from collections.abc import ItemsView, Mapping, ValuesView
+
+_MISSING = object()
+
+
+class StepHistory(Mapping):
+    '''
+        Compact replacement for the steps dict returned by calculateExpressions.
+        Only the variable changed by each step is stored, so memory grows with the
+        number of steps and not with steps times variables. The full state after a
+        step is rebuilt on demand by replaying the steps; the last rebuilt state is
+        kept, so reading steps in order replays each step once. It behaves like
+        the dict it replaces: same keys in the same order, same values, and it compares
+        equal to that dict. A statement that appears more than once keeps its first
+        position and shows the state after its last occurrence, like a dict would.
+
+        >>> steps = StepHistory()
+        >>> steps.record('a = 5', 'a', 5.0)
+        >>> steps.record('b = a', 'b', 5.0)
+        >>> steps.record('a = 7', 'a', 7.0)
+        >>> steps.setResult(12.0)
+        >>> steps['b = a']
+        {'a': 5.0, 'b': 5.0}
+        >>> steps['a = 7']
+        {'a': 7.0, 'b': 5.0}
+        >>> steps == {'a = 5': {'a': 5.0}, 'b = a': {'a': 5.0, 'b': 5.0}, 'a = 7': {'a': 7.0, 'b': 5.0}, '_return_': 12.0}
+        True
+        >>> steps.states
+        {'a': 7.0, 'b': 5.0}
+    '''
+    def __init__(self, initial=None):
+        self._initial = dict(initial) if initial else {}
+        # One entry per step: the statement, the variable it set and the new value
+        self._keys = []
+        self._vars = []
+        self._values = []
+        # Statement -> index of its last step, in first occurrence order
+        self._last = {}
+        # Index and state of the last step rebuilt by stateAt, where the next replay
+        # can start
+        self._cursor = -1
+        self._cursorState = dict(self._initial)
+        self._state = dict(self._initial)
+        self._result = _MISSING
+
+    def record(self, key, var, value):
+        index = len(self._keys)
+        self._keys.append(key)
+        self._vars.append(var)
+        self._values.append(value)
+        self._last[key] = index
+        self._state[var] = value
+
+    def setResult(self, value):
+        self._result = value
+
+    @property
+    def states(self):
+        # Final value of every variable
+        return dict(self._state)
+
+    def stateAt(self, index):
+        # Replay from the last rebuilt step if it comes before `index`, else from the start
+        if self._cursor <= index:
+            start = self._cursor
+            state = self._cursorState
+        else:
+            start = -1
+            state = dict(self._initial)
+        variables = self._vars
+        values = self._values
+        for i in range(start + 1, index + 1):
+            state[variables[i]] = values[i]
+        self._cursor = index
+        self._cursorState = state
+        return dict(state)
+
+    def __getitem__(self, key):
+        if key == "_return_" and self._result is not _MISSING:
+            return self._result
+        return self.stateAt(self._last[key])
+
+    def __contains__(self, key):
+        if key == "_return_":
+            return self._result is not _MISSING
+        return key in self._last
+
+    def __iter__(self):
+        yield from self._last
+        if self._result is not _MISSING:
+            yield "_return_"
+
+    def __len__(self):
+        return len(self._last) + (self._result is not _MISSING)
+
+    def items(self):
+        return _StepItems(self)
+
+    def values(self):
+        return _StepValues(self)
+
+    def _snapshots(self):
+        # One replay over all steps instead of one replay per key
+        last = self._last
+        state = dict(self._initial)
+        snapshots = {}
+        for i, (key, var, value) in enumerate(zip(self._keys, self._vars, self._values)):
+            state[var] = value
+            if last[key] == i:
+                snapshots[key] = dict(state)
+        for key in last:
+            yield key, snapshots.pop(key)
+        if self._result is not _MISSING:
+            yield "_return_", self._result
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class _StepItems(ItemsView):
+    def __iter__(self):
+        return self._mapping._snapshots()
+
+
+class _StepValues(ValuesView):
+    def __iter__(self):
+        for key, value in self._mapping._snapshots():
+            yield value
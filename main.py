@@ -1,9 +1,125 @@
-from advanced_calculator import AdvancedCalculator
-from calculator import Calculator
+import argparse
+import sys
+
+from advanced_calculator import AdvancedCalculator, runScript
+from cache import ParseCache, ResultCache
+from calculator import Calculator, CompiledExpr, evaluate, evaluateOrError
+from codegen import generateFunction
+from diskcache import loadCache, saveCache
+from guard import Limits, guardedEvaluate
+from history import StepHistory
+from metrics import Metrics
+from optimizer import foldConstants
 from stack import Stack
+from streaming import evaluateLines, evaluateStream
+from tokenizer import tokenize
 
-if __name__ == "__main__":
+
+def runDoctests():
     import doctest
     doctest.run_docstring_examples(Stack, globals(), verbose=True)
+    doctest.run_docstring_examples(tokenize, globals(), verbose=True)
     doctest.run_docstring_examples(Calculator, globals(), verbose=True)
-    doctest.run_docstring_examples(AdvancedCalculator, globals(), verbose=True)
\ No newline at end of file
+    doctest.run_docstring_examples(evaluate, globals(), verbose=True)
+    doctest.run_docstring_examples(evaluateOrError, globals(), verbose=True)
+    doctest.run_docstring_examples(guardedEvaluate, globals(), verbose=True)
+    doctest.run_docstring_examples(CompiledExpr, globals(), verbose=True)
+    doctest.run_docstring_examples(foldConstants, globals(), verbose=True)
+    doctest.run_docstring_examples(generateFunction, globals(), verbose=True)
+    doctest.run_docstring_examples(ParseCache, globals(), verbose=True)
+    doctest.run_docstring_examples(ResultCache, globals(), verbose=True)
+    doctest.run_docstring_examples(saveCache, globals(), verbose=True)
+    doctest.run_docstring_examples(Metrics, globals(), verbose=True)
+    doctest.run_docstring_examples(AdvancedCalculator, globals(), verbose=True)
+    doctest.run_docstring_examples(runScript, globals(), verbose=True)
+    doctest.run_docstring_examples(StepHistory, globals(), verbose=True)
+    doctest.run_docstring_examples(evaluateLines, globals(), verbose=True)
+    doctest.run_docstring_examples(evaluateStream, globals(), verbose=True)
+
+
+def evalCommand(args):
+    # Write each result as soon as it is produced so pipelines see output immediately
+    if not args.buffered:
+        sys.stdout.reconfigure(line_buffering=True)
+
+    if args.file == "-":
+        source = sys.stdin
+    else:
+        source = open(args.file)
+    try:
+        for result in evaluateLines(source):
+            sys.stdout.write("{}\n".format(result))
+    except BrokenPipeError:
+        # The reader went away (e.g. `| head`), so stop quietly
+        sys.stdout = None
+    finally:
+        if source is not sys.stdin:
+            source.close()
+
+
+def bulkCommand(args):
+    from bulk import evaluateFile
+
+    count = evaluateFile(args.input, args.output, args.workers)
+    print("{} lines evaluated into {}".format(count, args.output))
+
+
+def serveCommand(args):
+    import asyncio
+    from concurrent.futures import ProcessPoolExecutor
+    from server import CalculatorServer
+
+    executor = ProcessPoolExecutor(args.workers) if args.workers else None
+    limits = Limits() if args.guarded else None
+    # Start with every program compiled by the last run
+    cache = loadCache(args.cache_file, ParseCache(4096)) if args.cache_file else None
+    server = CalculatorServer(args.host, args.port, args.unix, args.concurrency, args.queue_size,
+                              args.timeout, executor=executor, cache=cache, limits=limits, lineLimit=args.line_limit)
+    try:
+        asyncio.run(server.serveForever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if args.cache_file:
+            saveCache(server.cache, args.cache_file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Infix calculator. Runs the doctests when no command is given.")
+    commands = parser.add_subparsers(dest="command")
+
+    evalParser = commands.add_parser("eval", help="evaluate one expression or script per line")
+    evalParser.add_argument("file", nargs="?", default="-", help="input file, or - for stdin (default)")
+    evalParser.add_argument("--buffered", action="store_true", help="buffer output instead of flushing every line")
+    evalParser.set_defaults(handler=evalCommand)
+
+    bulkParser = commands.add_parser("bulk", help="evaluate a large file into a binary float64 array and validity bitmap")
+    bulkParser.add_argument("input", help="file with one expression per line")
+    bulkParser.add_argument("output", help="binary result file")
+    bulkParser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    bulkParser.set_defaults(handler=bulkCommand)
+
+    serveParser = commands.add_parser("serve", help="serve line-delimited JSON requests over TCP or a Unix socket")
+    serveParser.add_argument("--host", default="127.0.0.1")
+    serveParser.add_argument("--port", type=int, default=8765)
+    serveParser.add_argument("--unix", metavar="PATH", help="listen on a Unix socket instead of TCP")
+    serveParser.add_argument("--concurrency", type=int, default=64, help="requests evaluated at once (default 64)")
+    serveParser.add_argument("--queue-size", type=int, default=128, help="requests in flight per connection (default 128)")
+    serveParser.add_argument("--timeout", type=float, default=5.0, help="default per-request deadline in seconds")
+    serveParser.add_argument("--workers", type=int, default=0, help="process pool size for scripts and batches (default: inline)")
+    serveParser.add_argument("--cache-file", metavar="PATH", help="load compiled programs from PATH at startup and save them on exit")
+    serveParser.add_argument("--line-limit", type=int, default=1 << 24, help="longest request line in bytes (default 16 MiB)")
+    serveParser.add_argument("--guarded", action="store_true", help="reject expressions over the default guard limits")
+    serveParser.set_defaults(handler=serveCommand)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        runDoctests()
+    else:
+        args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+from threading import Lock
+
+
+class Metrics:
+    '''
+        Opt-in registry of per-phase wall time and call counts plus named counters.
+        Pass one to Calculator or AdvancedCalculator to record the tokenize, postfix,
+        optimize, substitute (resolving script variables) and evaluate phases, the
+        number of tokens and the number of rejected inputs. Calculators without a Metrics only pay an `is None` check.
+        Hooks are called as `hook(phase, seconds)` for every recorded phase.
+
+        >>> from calculator import Calculator
+        >>> metrics = Metrics()
+        >>> calc = Calculator(metrics=metrics)
+        >>> calc.setExpr('1 + 2 * 3')
+        >>> calc.calculate
+        7.0
+        >>> calc.setExpr('1 + + 3')
+        >>> calc.calculate
+        >>> snap = metrics.snapshot()
+        >>> snap['counters']
+        {'tokens': 5, 'invalidExpressions': 1}
+        >>> snap['phases']['tokenize']['calls'], snap['phases']['evaluate']['calls']
+        (2, 1)
+        >>> seen = []
+        >>> metrics.hooks.append(lambda phase, seconds: seen.append(phase))
+        >>> calc.setExpr('2 ^ 2')
+        >>> calc.calculate
+        4.0
+        >>> seen
+        ['tokenize', 'postfix', 'optimize', 'evaluate']
+        >>> from advanced_calculator import runScript
+        >>> metrics = Metrics()
+        >>> runScript('b = a * 2;return b + 1', {'a': 1.0}, metrics=metrics)['_return_']
+        3.0
+        >>> sorted(metrics.snapshot()['phases'])
+        ['evaluate', 'optimize', 'postfix', 'substitute', 'tokenize']
+    '''
+    def __init__(self):
+        self.hooks = []
+        self.__phases = {}
+        self.__counters = {}
+        self.__lock = Lock()
+
+    def record(self, phase, seconds):
+        with self.__lock:
+            stats = self.__phases.get(phase)
+            if stats is None:
+                self.__phases[phase] = [1, seconds, seconds]
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                if seconds > stats[2]:
+                    stats[2] = seconds
+        for hook in self.hooks:
+            hook(phase, seconds)
+
+    def increment(self, name, amount=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def reset(self):
+        with self.__lock:
+            self.__phases.clear()
+            self.__counters.clear()
+
+    def snapshot(self):
+        '''
+            Return a copy of everything recorded so far, e.g.
+            {'phases': {'evaluate': {'calls': 1, 'seconds': 1e-06, 'max': 1e-06}}, 'counters': {'tokens': 5}}
+        '''
+        with self.__lock:
+            phases = {}
+            for phase, (calls, seconds, longest) in self.__phases.items():
+                phases[phase] = {'calls': calls, 'seconds': seconds, 'max': longest}
+            return {'phases': phases, 'counters': dict(self.__counters)}
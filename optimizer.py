@@ -0,0 +1,189 @@
+import math
+
+
+def _apply(op, first, second):
+    # Must match CompiledExpr.evaluate exactly
+    if op == "+":
+        return first + second
+    if op == "-":
+        return first - second
+    if op == "/":
+        return first / second
+    if op == "*":
+        return first * second
+    return first ** second
+
+
+def _isIdentity(op, constant, right):
+    # `x * 1`, `1 * x`, `x / 1`, `x ^ 1` and `x - 0` give back x bit for bit when
+    # x is a float. `x + 0` is not included: -0.0 + 0.0 is 0.0, which changes the sign.
+    if constant == 1.0:
+        return op == "*" or (right and op in "/^")
+    if constant == 0.0 and math.copysign(1.0, constant) > 0:
+        return right and op == "-"
+    return False
+
+
+def foldConstants(program):
+    '''
+        Fold constant subexpressions of a postfix program and drop operations with
+        an identity operand. Folding uses the same float operations as evaluation,
+        so results are unchanged; operations that would raise (such as division by
+        zero) or produce a non-float result are left for evaluation time.
+
+        >>> from calculator import Calculator
+        >>> foldConstants(Calculator.compile('2 * 3 ^ 2 + x', names=True, optimize=False).program)
+        [18.0, Load('x'), '+']
+        >>> foldConstants(Calculator.compile('( x * 1 ) - 0 + ( 5 - 3 ) * y', names=True, optimize=False).program)
+        [Load('x'), 2.0, Load('y'), '*', '+']
+        >>> foldConstants(Calculator.compile('x + 0', names=True, optimize=False).program)
+        [Load('x'), 0.0, '+']
+        >>> foldConstants(Calculator.compile('1 / 0 + 2', optimize=False).program)
+        [1.0, 0.0, '/', 2.0, '+']
+    '''
+    # Subexpressions are contiguous in the output, so the stack only holds
+    # (start index in `out`, value or None if not constant) for each operand
+    out = []
+    stack = []
+    for term in program:
+        if term.__class__ is float:
+            stack.append((len(out), term))
+            out.append(term)
+        elif term.__class__ is not str:
+            # Variable loads are never constant
+            stack.append((len(out), None))
+            out.append(term)
+        else:
+            rightStart, right = stack.pop()
+            leftStart, left = stack.pop()
+            if left is not None and right is not None:
+                try:
+                    value = _apply(term, left, right)
+                except ArithmeticError:
+                    value = None
+                # Complex results (e.g. a negative number to a fractional power) stay unfolded
+                if value.__class__ is float:
+                    del out[leftStart:]
+                    stack.append((leftStart, value))
+                    out.append(value)
+                    continue
+            if right is not None and _isIdentity(term, right, True):
+                del out[rightStart:]
+                stack.append((leftStart, left))
+                continue
+            if left is not None and _isIdentity(term, left, False):
+                del out[leftStart]
+                stack.append((leftStart, right))
+                continue
+            stack.append((leftStart, None))
+            out.append(term)
+
+    return out
+
+
+class SharedScript:
+    '''
+        Script compiled into a single graph of values in which every distinct
+        subexpression appears once. Values are numbered: the script's inputs come
+        first, then its constants, then one value per entry of `operations`, an
+        (operator, left, right) tuple read in order. `statements` holds
+        (statement, variable, value) for each assignment and `result` the value of
+        the return expression.
+    '''
+    __slots__ = ('inputs', 'constants', 'operations', 'statements', 'result')
+
+    def __init__(self, inputs, constants, operations, statements, result):
+        self.inputs = tuple(inputs)
+        self.constants = tuple(constants)
+        self.operations = tuple(operations)
+        self.statements = tuple(statements)
+        self.result = result
+
+    def evaluate(self, bindings):
+        # Returns the list of every value; each operation runs exactly once
+        values = [bindings[name] for name in self.inputs]
+        values.extend(self.constants)
+        append = values.append
+        for op, left, right in self.operations:
+            first = values[left]
+            second = values[right]
+            if op == "+":
+                append(first + second)
+            elif op == "-":
+                append(first - second)
+            elif op == "/":
+                append(first / second)
+            elif op == "*":
+                append(first * second)
+            else:
+                append(first ** second)
+        return values
+
+
+def shareSubexpressions(script):
+    '''
+        Hash-cons the subexpressions of every statement of a compiled script and of
+        its return expression, so that a subexpression repeated anywhere in the
+        script is computed once per run. Variables are tracked by value rather than
+        by name, so a reassignment such as `a = 7` after `a = 5` gives `a` a new
+        value and the expressions read after it are not confused with earlier ones.
+        Operands of `+` and `*` are put in a fixed order, which is exact for floats,
+        so `a + b` and `b + a` are shared too.
+
+        >>> from advanced_calculator import compileScript
+        >>> shared = shareSubexpressions(compileScript('x = ( a + b ) * c;y = c * ( b + a );a = 7;z = ( a + b ) * c;return x + y', ('a', 'b', 'c')))
+        >>> shared.inputs, shared.constants
+        (('a', 'b', 'c'), (7.0,))
+        >>> shared.operations
+        (('+', 0, 1), ('*', 2, 4), ('+', 3, 1), ('*', 2, 6), ('+', 5, 5))
+        >>> [(var, value) for statement, var, value in shared.statements], shared.result
+        ([('x', 5), ('y', 5), ('a', 3), ('z', 7)], 8)
+    '''
+    inputs = []
+    constants = {}
+    operations = {}
+    # Variable name -> value currently assigned to it, or its input value
+    current = {}
+
+    def valueOf(program):
+        stack = []
+        for term in program.program:
+            if term.__class__ is float:
+                # -0.0 == 0.0, so the sign is part of the key
+                key = (term, math.copysign(1.0, term))
+                if key not in constants:
+                    constants[key] = len(constants)
+                stack.append(("constant", constants[key]))
+            elif term.__class__ is not str:
+                if term.name not in current:
+                    current[term.name] = ("input", len(inputs))
+                    inputs.append(term.name)
+                stack.append(current[term.name])
+            else:
+                right = stack.pop()
+                left = stack.pop()
+                if term in "+*" and right < left:
+                    left, right = right, left
+                key = (term, left, right)
+                if key not in operations:
+                    operations[key] = len(operations)
+                stack.append(("operation", operations[key]))
+        return stack.pop()
+
+    statements = []
+    for expr, var, slot, program in script.statements:
+        value = valueOf(program)
+        statements.append((expr, var, value))
+        current[var] = value
+    result = valueOf(script.result)
+
+    # Number the values: inputs, then constants, then operations in creation order
+    base = {"input": 0, "constant": len(inputs), "operation": len(inputs) + len(constants)}
+
+    def number(value):
+        return base[value[0]] + value[1]
+
+    sharedOperations = [(op, number(left), number(right)) for op, left, right in operations]
+    sharedStatements = [(expr, var, number(value)) for expr, var, value in statements]
+    return SharedScript(inputs, [value for value, sign in constants], sharedOperations,
+                        sharedStatements, number(result))
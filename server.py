@@ -0,0 +1,314 @@
+'''
+    asyncio evaluation service speaking line-delimited JSON over TCP or a Unix socket.
+
+    Each request is one JSON object per line:
+
+        {"id": 1, "expr": "2 * (3 + 4)"}
+        {"id": 2, "script": "b = a * 2;return b + 1", "bindings": {"a": 5}}
+        {"id": 3, "batch": ["1 + 1", "2 ^ 10"]}
+        {"id": 4, "expr": "9 ^ 9 ^ 9", "timeout": 0.5}
+
+    and gets one JSON line back, in completion order, echoing its id:
+
+        {"id": 1, "result": 14.0}
+        {"id": 3, "result": [2.0, 1024.0]}
+        {"id": 5, "result": null, "error": "invalid expression"}
+
+    All clients share one process and its parse cache. `concurrency` bounds how many
+    requests are evaluated at once, `queueSize` bounds the requests in flight per
+    connection (the server stops reading from a client whose queue is full), and
+    every request has a deadline. Request lines longer than `lineLimit` bytes are
+    answered with a "request too large" error and skipped.
+
+    Scripts, batches and long expressions are evaluated off the event loop, on the
+    given executor (such as a process pool) or else on a thread pool owned by the
+    server, so a slow request neither blocks other clients nor outlives its
+    deadline: it is answered with "deadline exceeded" when the deadline passes,
+    although its evaluation finishes in the background. Short expressions are
+    evaluated inline.
+'''
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from advanced_calculator import runScript
+from cache import ParseCache
+from calculator import Calculator, evaluate
+from guard import guardedEvaluate
+from tokenizer import LimitExceeded
+
+# Expressions up to this many characters are cheap enough to evaluate on the event loop
+INLINE_LENGTH = 4096
+
+# Marks a request line that was longer than the server's line limit
+TOO_LARGE = object()
+
+
+def evaluateRequest(request, cache=None, limits=None):
+    '''
+        Evaluate one decoded request and return the response without its id.
+        With `limits`, expressions and batch entries go through guardedEvaluate.
+
+        >>> evaluateRequest({'expr': '2 * (3 + 4)'})
+        {'result': 14.0}
+        >>> evaluateRequest({'script': 'b = a * 2;return b + 1', 'bindings': {'a': 5}})
+        {'result': 11.0}
+        >>> evaluateRequest({'batch': ['1 + 1', '4 +']})
+        {'result': [2.0, None]}
+        >>> evaluateRequest({'expr': '4 +'})
+        {'result': None, 'error': 'invalid expression'}
+        >>> evaluateRequest({'script': 'return a', 'bindings': [1]})
+        {'result': None, 'error': 'bindings must be an object'}
+        >>> evaluateRequest({'sum': [1, 2]})
+        {'result': None, 'error': 'request needs one of expr, script or batch'}
+        >>> from guard import Limits
+        >>> evaluateRequest({'expr': '9 ^ 9 ^ 9'}, limits=Limits())
+        {'result': None, 'error': 'limit exceeded', 'limit': 'magnitude', 'position': None}
+    '''
+    try:
+        if "expr" in request:
+            if limits is None:
+                result = evaluate(request["expr"], cache)
+            else:
+                result = guardedEvaluate(request["expr"], limits, cache)
+            if result is None:
+                return {"result": None, "error": "invalid expression"}
+            return {"result": _jsonValue(result)}
+
+        if "script" in request:
+            bindings = request.get("bindings")
+            if bindings is not None and not isinstance(bindings, dict):
+                return {"result": None, "error": "bindings must be an object"}
+            steps = runScript(request["script"], bindings, cache, history="none")
+            if steps is None:
+                return {"result": None, "error": "invalid script"}
+            return {"result": _jsonValue(steps["_return_"])}
+
+        if "batch" in request:
+            if limits is None:
+                results = Calculator.evaluateMany(request["batch"], workers=1, cache=cache)
+            else:
+                results = [_guardedEntry(expr, limits, cache) for expr in request["batch"]]
+            return {"result": [_jsonValue(result) for result in results]}
+    except LimitExceeded as error:
+        return {"result": None, "error": "limit exceeded", "limit": error.limit, "position": error.position}
+    except (ArithmeticError, TypeError, ValueError) as error:
+        return {"result": None, "error": "{}: {}".format(type(error).__name__, error)}
+
+    return {"result": None, "error": "request needs one of expr, script or batch"}
+
+
+def _guardedEntry(expr, limits, cache):
+    # Batch entries that are rejected or fail give None, like evaluateMany
+    try:
+        return guardedEvaluate(expr, limits, cache)
+    except (ArithmeticError, ValueError):
+        return None
+
+
+def _jsonValue(value):
+    # Complex results (negative number to a fractional power) have no JSON form
+    if isinstance(value, complex):
+        raise ValueError("complex result")
+    return value
+
+
+class CalculatorServer:
+    '''
+        >>> async def demo():
+        ...     server = CalculatorServer(port=0)
+        ...     await server.start()
+        ...     port = server.sockets[0].getsockname()[1]
+        ...     reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        ...     writer.write(b'{"id": 7, "expr": "1 + 2"}\\n')
+        ...     reply = await reader.readline()
+        ...     writer.close()
+        ...     await server.close()
+        ...     return json.loads(reply)
+        >>> asyncio.run(demo())
+        {'id': 7, 'result': 3.0}
+        >>> async def tooLarge():
+        ...     server = CalculatorServer(port=0, lineLimit=64)
+        ...     await server.start()
+        ...     port = server.sockets[0].getsockname()[1]
+        ...     reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        ...     writer.write(b'{"expr": "' + b'1 + ' * 100 + b'1"}\\n{"id": 8, "expr": "2 * 3"}\\n')
+        ...     replies = [json.loads(await reader.readline()) for _ in range(2)]
+        ...     writer.close()
+        ...     await server.close()
+        ...     return replies
+        >>> asyncio.run(tooLarge())
+        [{'result': None, 'error': 'request too large'}, {'id': 8, 'result': 6.0}]
+    '''
+    def __init__(self, host="127.0.0.1", port=8765, path=None, concurrency=64, queueSize=128,
+                 timeout=5.0, maxTimeout=60.0, executor=None, cache=None, limits=None, lineLimit=1 << 24):
+        self.host = host
+        self.port = port
+        # A Unix socket path takes precedence over host/port
+        self.path = path
+        self.concurrency = concurrency
+        self.queueSize = queueSize
+        self.timeout = timeout
+        self.maxTimeout = maxTimeout
+        # Optional concurrent.futures executor for scripts, batches and long expressions;
+        # without one the server uses its own thread pool
+        self.executor = executor
+        self.cache = ParseCache(4096) if cache is None else cache
+        # Optional guard.Limits applied to expressions and batches
+        self.limits = limits
+        # Longest request line in bytes; asyncio's default of 64 KiB is too small for long scripts
+        self.lineLimit = lineLimit
+        self.sockets = ()
+        self.__server = None
+        self.__slots = None
+        self.__threads = None
+        # Handler task of every open connection, cancelled by close()
+        self.__clients = set()
+
+    async def start(self):
+        self.__slots = asyncio.Semaphore(self.concurrency)
+        if self.executor is None and self.__threads is None:
+            self.__threads = ThreadPoolExecutor(min(self.concurrency, 32), "calculator")
+        if self.path is not None:
+            self.__server = await asyncio.start_unix_server(self._handleClient, path=self.path, limit=self.lineLimit)
+        else:
+            self.__server = await asyncio.start_server(self._handleClient, self.host, self.port, limit=self.lineLimit)
+        self.sockets = self.__server.sockets
+
+    async def serveForever(self):
+        if self.__server is None:
+            await self.start()
+        try:
+            async with self.__server:
+                await self.__server.serve_forever()
+        finally:
+            self._shutdownThreads()
+
+    async def close(self):
+        if self.__server is not None:
+            self.__server.close()
+            clients = list(self.__clients)
+            for client in clients:
+                client.cancel()
+            await asyncio.gather(*clients, return_exceptions=True)
+            await self.__server.wait_closed()
+        self._shutdownThreads()
+
+    def _shutdownThreads(self):
+        if self.__threads is not None:
+            # Evaluations past their deadline are not waited for
+            self.__threads.shutdown(wait=False, cancel_futures=True)
+            self.__threads = None
+
+    async def _handleClient(self, reader, writer):
+        # Bounds the requests in flight for this client; once it is full we stop
+        # reading, so TCP flow control pushes back on the client
+        pending = asyncio.Semaphore(self.queueSize)
+        writeLock = asyncio.Lock()
+        tasks = set()
+        client = asyncio.current_task()
+        self.__clients.add(client)
+        try:
+            while True:
+                await pending.acquire()
+                line = await self._readLine(reader)
+                if not line:
+                    pending.release()
+                    break
+                task = asyncio.ensure_future(self._handleLine(line, writer, writeLock, pending))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # The server is closing; end the connection instead of failing the handler
+            pass
+        finally:
+            self.__clients.discard(client)
+            for task in tasks:
+                task.cancel()
+            # Shut down the write side explicitly: forked executor workers may hold a
+            # copy of this socket, and close() alone would not end the stream for them
+            if writer.can_write_eof() and not writer.is_closing():
+                try:
+                    writer.write_eof()
+                except OSError:
+                    pass
+            writer.close()
+
+    async def _readLine(self, reader):
+        # A line, b"" at the end of the stream, or TOO_LARGE for a line over the
+        # limit, which is skipped up to its newline
+        try:
+            return await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as error:
+            # The last line may have no newline
+            return error.partial
+        except asyncio.LimitOverrunError as error:
+            skip = error.consumed
+        while True:
+            await reader.readexactly(skip)
+            try:
+                await reader.readuntil(b"\n")
+                return TOO_LARGE
+            except asyncio.LimitOverrunError as error:
+                skip = error.consumed
+
+    async def _handleLine(self, line, writer, writeLock, pending):
+        try:
+            if line is TOO_LARGE:
+                response = {"result": None, "error": "request too large"}
+            else:
+                try:
+                    response = await self._respond(line)
+                except Exception as error:
+                    # Every request gets a reply, whatever went wrong
+                    response = {"result": None, "error": "{}: {}".format(type(error).__name__, error)}
+            data = json.dumps(response).encode() + b"\n"
+            async with writeLock:
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            pending.release()
+
+    async def _respond(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {"result": None, "error": "malformed JSON"}
+        if not isinstance(request, dict):
+            return {"result": None, "error": "request must be a JSON object"}
+
+        response = {}
+        if "id" in request:
+            response["id"] = request["id"]
+        timeout = request.get("timeout", self.timeout)
+        if not isinstance(timeout, (int, float)) or timeout <= 0:
+            timeout = self.timeout
+        timeout = min(timeout, self.maxTimeout)
+
+        try:
+            # The deadline covers waiting for a free slot as well as evaluation
+            response.update(await asyncio.wait_for(self._evaluate(request), timeout))
+        except asyncio.TimeoutError:
+            response.update({"result": None, "error": "deadline exceeded"})
+        except Exception as error:
+            # e.g. a broken process pool; the client still gets a reply for this id
+            response.update({"result": None, "error": "{}: {}".format(type(error).__name__, error)})
+        return response
+
+    async def _evaluate(self, request):
+        async with self.__slots:
+            expr = request.get("expr")
+            if isinstance(expr, str) and len(expr) <= INLINE_LENGTH:
+                return evaluateRequest(request, self.cache, self.limits)
+            loop = asyncio.get_running_loop()
+            if self.executor is None:
+                # The server's own threads share its cache
+                return await loop.run_in_executor(self.__threads, evaluateRequest, request, self.cache, self.limits)
+            # Worker processes keep their own caches, so none is sent along
+            return await loop.run_in_executor(self.executor, evaluateRequest, request, None, self.limits)
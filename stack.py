@@ -1,4 +1,6 @@
 class Node:
+    __slots__ = ('value', 'next')
+
     def __init__(self, value):
         self.value = value  
         self.next = None 
@@ -33,49 +35,50 @@ class Stack:
         >>> x.peek()
         4
     '''
+    __slots__ = ('_items',)
+
     def __init__(self):
-        self.top:Node = None
+        # The end of the list is the top of the stack
+        self._items = []
+
+    @property
+    def top(self):
+        if not self._items:
+            return None
+        return Node(self._items[-1])
     
     def __str__(self):
-        temp=self.top
-        out=[]
-        while temp:
-            out.append(str(temp.value))
-            temp=temp.next
-        out='\n'.join(out)
+        out='\n'.join(str(value) for value in reversed(self._items))
         return ('Top:{}\nStack:\n{}'.format(self.top,out))
 
     __repr__=__str__
 
     def isEmpty(self):
 
-        return self.top == None
+        return not self._items
 
     def __len__(self): 
 
-        count = 0
-        current = self.top
-        while current is not None:
-            count += 1
-            current = current.next
-        return count
+        return len(self._items)
 
     def push(self,value):
 
-        new = Node(value)
-        new.next = self.top
-        self.top = new
+        self._items.append(value)
 
     def pop(self):
 
-        top_node = self.top
-        if top_node is not None:
-            self.top = self.top.next
-            return top_node.value
+        items = self._items
+        if items:
+            return items.pop()
         return None
 
     def peek(self):
 
-        if self.isEmpty():
-            return None
-        return self.top.value
\ No newline at end of file
+        items = self._items
+        if items:
+            return items[-1]
+        return None
+
+    def clear(self):
+        # Lets one stack be reused between evaluations
+        self._items.clear()
\ No newline at end of file
@@ -0,0 +1,248 @@
+import codecs
+import re
+
+from advanced_calculator import AdvancedCalculator
+from cache import ParseCache
+from calculator import Calculator, PRECEDENCE
+from tokenizer import InvalidExpression
+
+# A run of digits and dots may continue in the next chunk; everything else is one character
+_LEXEME = re.compile(r"[0-9.]+|[^ \t\n\r\f\v]")
+_NUMBER_CHARS = "0123456789."
+
+
+def evaluateLine(line, cache=None):
+    '''
+        Evaluate one line of input. Lines containing `;` or starting with `return`
+        are AdvancedCalculator scripts and give their `_return_` value; any other line
+        is a single expression. Invalid input and arithmetic errors give None.
+
+        >>> evaluateLine(' 2 * (3 + 4)\\n')
+        14.0
+        >>> evaluateLine('a = 5;b = a * 2;return b + 1')
+        11.0
+        >>> evaluateLine('4 +')
+        >>> evaluateLine('1 / 0')
+    '''
+    line = line.strip()
+    try:
+        if ";" in line or line.startswith("return"):
+            calc = AdvancedCalculator(cache)
+            calc.setExpression(line)
+            steps = calc.calculateExpressions()
+            return None if steps is None else steps["_return_"]
+
+        program = Calculator.compile(line, cache)
+        return None if program is None else program.evaluate()
+    except ArithmeticError:
+        return None
+
+
+def evaluateLines(lines, cache=None):
+    '''
+        Lazily evaluate an iterable of lines, such as an open file or sys.stdin,
+        yielding one result per line as soon as it is computed. Only one line is
+        held in memory at a time. Repeated lines are served from a ParseCache.
+
+        >>> list(evaluateLines(['1 + 1\\n', 'return 3 ^ 2\\n', '2 2\\n']))
+        [2.0, 9.0, None]
+    '''
+    if cache is None:
+        cache = ParseCache()
+    for line in lines:
+        yield evaluateLine(line, cache)
+
+
+def evaluateStream(source, chunksize=1 << 16):
+    '''
+        Evaluate one expression read in chunks from a file-like object or an
+        iterable of str or bytes chunks, without ever holding the whole text.
+        Tokenizing, the shunting-yard conversion and evaluation run together in a
+        single pass, so memory grows with the nesting depth of the expression (and
+        the length of `^` chains, which are right associative) rather than with its
+        length. Gives the same result as evaluating the text in one piece: None if
+        it is invalid, and arithmetic errors are raised only once the whole
+        expression has been checked.
+
+        >>> evaluateStream(['2 * (3', '.5 + 1', ')'])
+        9.0
+        >>> import io
+        >>> evaluateStream(io.StringIO('7^2^3 - -(1)'), chunksize=2)
+        5764802.0
+        >>> evaluateStream(['1 +', ' 2 2'])
+        >>> evaluateStream(iter([b'1 / 0 +']))
+    '''
+    try:
+        return _StreamEvaluator().run(_chunks(source, chunksize))
+    except InvalidExpression:
+        return None
+
+
+def _chunks(source, chunksize):
+    if hasattr(source, "read"):
+        read = source.read
+        source = iter(lambda: read(chunksize), read(0))
+    decoder = None
+    for chunk in source:
+        if isinstance(chunk, bytes):
+            # Multi-byte characters may be split between chunks
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder("utf-8")("replace")
+            chunk = decoder.decode(chunk)
+        yield chunk
+
+
+class _StreamEvaluator:
+    # Mirrors tokenizer.tokenize and Calculator._postfixTerms, but applies every
+    # operator as soon as shunting-yard would emit it
+
+    def __init__(self):
+        self.values = []
+        self.operators = []
+        self.depth = 0
+        # True when the next token must be an operand
+        self.expectOperand = True
+        # Kind of the last token: None, "number", "operator", "negate", "(" or ")"
+        self.last = None
+        self.lastPosition = 0
+        # Position of a unary minus waiting for its operand
+        self.minus = None
+        # First arithmetic error; evaluation stops but the text is still checked
+        self.failure = None
+
+    def run(self, chunks):
+        carry = ""
+        offset = 0
+        for chunk in chunks:
+            text = carry + chunk
+            # Keep a trailing run of digits and dots, it may continue in the next chunk
+            cut = len(text)
+            while cut > 0 and text[cut - 1] in _NUMBER_CHARS:
+                cut -= 1
+            self.scan(text, 0, cut, offset)
+            carry = text[cut:]
+            offset += cut
+        self.scan(carry, 0, len(carry), offset)
+        return self.finish(offset + len(carry))
+
+    def scan(self, text, start, end, offset):
+        for match in _LEXEME.finditer(text, start, end):
+            self.lexeme(match.group(), offset + match.start())
+
+    def lexeme(self, lexeme, position):
+        ch = lexeme[0]
+        if ch in _NUMBER_CHARS:
+            if lexeme == "." or lexeme.count(".") > 1:
+                raise InvalidExpression(position, "malformed number")
+            if self.minus is not None:
+                # The unary minus is folded into the number
+                self.minus = None
+                self.number(-float(lexeme), position)
+                return
+            if not self.expectOperand:
+                if self.last == ")":
+                    raise InvalidExpression(position, "implied multiplication")
+                raise InvalidExpression(position, "missing operator")
+            self.number(float(lexeme), position)
+            return
+
+        if self.minus is not None:
+            if ch != "(":
+                raise InvalidExpression(position, "consecutive operators")
+            self.minus = None
+            self.operators.append("negate")
+            self.last = "negate"
+
+        if ch in PRECEDENCE:
+            if not self.expectOperand:
+                self.operator(ch)
+                self.last = "operator"
+                self.lastPosition = position
+                self.expectOperand = True
+            elif ch != "-" or self.last == "negate":
+                if self.last is None:
+                    raise InvalidExpression(position, "expression cannot start with an operator")
+                raise InvalidExpression(position, "consecutive operators")
+            else:
+                self.minus = position
+
+        elif ch == "(":
+            if not self.expectOperand:
+                raise InvalidExpression(position, "implied multiplication")
+            self.operators.append("(")
+            self.depth += 1
+            self.last = "("
+
+        elif ch == ")":
+            if self.depth == 0:
+                raise InvalidExpression(position, "unbalanced parenthesis")
+            if self.expectOperand:
+                if self.last == "(":
+                    raise InvalidExpression(position, "empty parenthesis")
+                raise InvalidExpression(position, "missing operand")
+            operators = self.operators
+            while operators[-1] != "(":
+                self.apply(operators.pop())
+            operators.pop()
+            # A unary minus in front of the parenthesis negates the whole group
+            if operators and operators[-1] == "negate":
+                operators.pop()
+                self.values.append(-1.0)
+                self.apply("*")
+            self.depth -= 1
+            self.last = ")"
+
+        else:
+            raise InvalidExpression(position, "unsupported character {!r}".format(ch))
+
+    def number(self, value, position):
+        self.values.append(value)
+        self.expectOperand = False
+        self.last = "number"
+
+    def operator(self, term):
+        operators = self.operators
+        # `term != "^"` keeps exponents right associative
+        while operators and operators[-1] != "(" and PRECEDENCE[operators[-1]] >= PRECEDENCE[term] and term != "^":
+            self.apply(operators.pop())
+        operators.append(term)
+
+    def apply(self, term):
+        values = self.values
+        second = values.pop()
+        first = values.pop()
+        if self.failure is not None:
+            values.append(None)
+            return
+        try:
+            if term == "+":
+                res = first + second
+            elif term == "-":
+                res = first - second
+            elif term == "/":
+                res = first / second
+            elif term == "*":
+                res = first * second
+            else:
+                res = first ** second
+        except ArithmeticError as error:
+            self.failure = error
+            res = None
+        values.append(res)
+
+    def finish(self, end):
+        if self.minus is not None:
+            raise InvalidExpression(self.minus, "expression cannot end with an operator")
+        if self.last is None:
+            raise InvalidExpression(0, "empty expression")
+        if self.expectOperand:
+            if self.last == "operator":
+                raise InvalidExpression(self.lastPosition, "expression cannot end with an operator")
+            raise InvalidExpression(end, "missing operand")
+        if self.depth != 0:
+            raise InvalidExpression(end, "unbalanced parenthesis")
+        while self.operators:
+            self.apply(self.operators.pop())
+        if self.failure is not None:
+            raise self.failure
+        return self.values.pop()
@@ -0,0 +1,248 @@
+NUMBER = "number"
+OPERATOR = "operator"
+LPAREN = "lparen"
+RPAREN = "rparen"
+NEGATE = "negate"
+NAME = "name"
+
+OPERATORS = "+-*/^"
+DIGITS = "0123456789"
+WHITESPACE = " \t\n\r\f\v"
+
+
+class InvalidExpression(ValueError):
+    '''
+        Raised by `tokenize` with the character position and reason of the first error.
+
+        >>> err = InvalidExpression(4, "consecutive operators")
+        >>> err.position, err.reason
+        (4, 'consecutive operators')
+        >>> str(err)
+        'consecutive operators at position 4'
+    '''
+    def __init__(self, position, reason):
+        super().__init__("{} at position {}".format(reason, position))
+        self.position = position
+        self.reason = reason
+
+
+class LimitExceeded(InvalidExpression):
+    '''
+        Raised when guarded evaluation rejects an input for exceeding one of its
+        limits. `limit` names the limit and `maximum` is its configured value;
+        `position` is None for limits that are not tied to a place in the text.
+
+        >>> err = LimitExceeded("depth", 2, 6)
+        >>> err.limit, err.maximum, err.position
+        ('depth', 2, 6)
+        >>> str(err)
+        'depth limit of 2 exceeded at position 6'
+        >>> str(LimitExceeded("time", 0.5))
+        'time limit of 0.5 exceeded'
+    '''
+    def __init__(self, limit, maximum, position=None):
+        reason = "{} limit of {} exceeded".format(limit, maximum)
+        super().__init__(position, reason)
+        if position is None:
+            self.args = (reason,)
+        self.limit = limit
+        self.maximum = maximum
+
+
+class Token:
+    __slots__ = ('kind', 'text', 'value', 'position')
+
+    def __init__(self, kind, text, value, position):
+        self.kind = kind
+        self.text = text
+        self.value = value
+        self.position = position
+
+    def __str__(self):
+        return "Token({}, {!r})".format(self.kind, self.text)
+
+    __repr__ = __str__
+
+
+def _scanNumber(expr, start, end):
+    # Returns the index just past the number starting at `start`
+    i = start
+    while i < end and expr[i] in DIGITS:
+        i += 1
+    if i < end and expr[i] == ".":
+        i += 1
+        while i < end and expr[i] in DIGITS:
+            i += 1
+    return i
+
+
+def _scanName(expr, start, end):
+    # Variable names start with a letter and only contain alphanumeric characters
+    i = start + 1
+    while i < end and expr[i].isalnum():
+        i += 1
+    return i
+
+
+def tokenize(expr, names=False, maxTokens=None, maxDepth=None, start=0, end=None):
+    '''
+        Walk `expr` once and return a list of typed tokens. A minus sign in operand
+        position is folded into the following number, or becomes a NEGATE token when
+        it is followed by a parenthesis or a variable. Variable names are only
+        accepted when `names` is True. Invalid expressions raise InvalidExpression.
+        Scanning stops with LimitExceeded as soon as the expression has more than
+        `maxTokens` tokens or nests parentheses deeper than `maxDepth`.
+        `start` and `end` limit scanning to a slice of `expr` without copying it;
+        token and error positions are still offsets into `expr`.
+
+        >>> tokenize("2 * (-3.5 + 1)")
+        [Token(number, '2'), Token(operator, '*'), Token(lparen, '('), Token(number, '-3.5'), Token(operator, '+'), Token(number, '1'), Token(rparen, ')')]
+        >>> [t.value for t in tokenize("3*-3 + .5")]
+        [3.0, '*', -3.0, '+', 0.5]
+        >>> tokenize("-(2)")
+        [Token(negate, '-'), Token(lparen, '('), Token(number, '2'), Token(rparen, ')')]
+        >>> tokenize("x1 * -y", names=True)
+        [Token(name, 'x1'), Token(operator, '*'), Token(negate, '-'), Token(name, 'y')]
+        >>> tokenize("x1 * 2")
+        Traceback (most recent call last):
+        ...
+        tokenizer.InvalidExpression: unsupported character 'x' at position 0
+        >>> tokenize("4 3 + 1")
+        Traceback (most recent call last):
+        ...
+        tokenizer.InvalidExpression: missing operator at position 2
+        >>> tokenize("2 * 5 + 3 ^ + -2")
+        Traceback (most recent call last):
+        ...
+        tokenizer.InvalidExpression: consecutive operators at position 12
+        >>> tokenize("3 ( 5)")
+        Traceback (most recent call last):
+        ...
+        tokenizer.InvalidExpression: implied multiplication at position 2
+        >>> tokenize("(5 + 6))")
+        Traceback (most recent call last):
+        ...
+        tokenizer.InvalidExpression: unbalanced parenthesis at position 7
+        >>> tokenize("2 *      5% + 3")
+        Traceback (most recent call last):
+        ...
+        tokenizer.InvalidExpression: unsupported character '%' at position 10
+        >>> tokenize("25 +")
+        Traceback (most recent call last):
+        ...
+        tokenizer.InvalidExpression: expression cannot end with an operator at position 3
+        >>> tokenize("((((1))))", maxDepth=3)
+        Traceback (most recent call last):
+        ...
+        tokenizer.LimitExceeded: depth limit of 3 exceeded at position 3
+        >>> tokenize("a = 2 * b;", names=True, start=3, end=9)
+        [Token(number, '2'), Token(operator, '*'), Token(name, 'b')]
+    '''
+    tokens = []
+    append = tokens.append
+    if end is None:
+        end = len(expr)
+    depth = 0
+    # Every token takes at least one character, so short inputs need no count check
+    countTokens = maxTokens is not None and maxTokens < end - start
+    # True when the next token must be an operand: a number, '(' or a unary minus
+    expectOperand = True
+    i = start
+
+    while i < end:
+        if countTokens and len(tokens) > maxTokens:
+            raise LimitExceeded("tokens", maxTokens, tokens[maxTokens].position)
+        ch = expr[i]
+
+        if ch in WHITESPACE:
+            i += 1
+
+        elif ch in DIGITS or ch == ".":
+            j = _scanNumber(expr, i, end)
+            text = expr[i:j]
+            if text == "." or (j < end and expr[j] == "."):
+                raise InvalidExpression(i, "malformed number")
+            if not expectOperand:
+                if tokens[-1].kind == RPAREN:
+                    raise InvalidExpression(i, "implied multiplication")
+                raise InvalidExpression(i, "missing operator")
+            append(Token(NUMBER, text, float(text), i))
+            expectOperand = False
+            i = j
+
+        elif ch in OPERATORS:
+            if not expectOperand:
+                append(Token(OPERATOR, ch, ch, i))
+                expectOperand = True
+                i += 1
+                continue
+
+            # Operator in operand position: only a single unary minus is allowed
+            if ch != "-" or (tokens and tokens[-1].kind == NEGATE):
+                if not tokens:
+                    raise InvalidExpression(i, "expression cannot start with an operator")
+                raise InvalidExpression(i, "consecutive operators")
+            j = i + 1
+            while j < end and expr[j] in WHITESPACE:
+                j += 1
+            if j < end and (expr[j] in DIGITS or expr[j] == "."):
+                k = _scanNumber(expr, j, end)
+                digits = expr[j:k]
+                if digits == "." or (k < end and expr[k] == "."):
+                    raise InvalidExpression(j, "malformed number")
+                append(Token(NUMBER, "-" + digits, -float(digits), i))
+                expectOperand = False
+                i = k
+            elif j < end and (expr[j] == "(" or (names and expr[j].isalpha())):
+                append(Token(NEGATE, ch, ch, i))
+                i += 1
+            elif j < end:
+                raise InvalidExpression(j, "consecutive operators")
+            else:
+                raise InvalidExpression(i, "expression cannot end with an operator")
+
+        elif ch == "(":
+            if not expectOperand:
+                raise InvalidExpression(i, "implied multiplication")
+            append(Token(LPAREN, ch, ch, i))
+            depth += 1
+            if maxDepth is not None and depth > maxDepth:
+                raise LimitExceeded("depth", maxDepth, i)
+            i += 1
+
+        elif ch == ")":
+            if depth == 0:
+                raise InvalidExpression(i, "unbalanced parenthesis")
+            if expectOperand:
+                if tokens[-1].kind == LPAREN:
+                    raise InvalidExpression(i, "empty parenthesis")
+                raise InvalidExpression(i, "missing operand")
+            append(Token(RPAREN, ch, ch, i))
+            depth -= 1
+            i += 1
+
+        elif names and ch.isalpha():
+            j = _scanName(expr, i, end)
+            if not expectOperand:
+                if tokens[-1].kind == RPAREN:
+                    raise InvalidExpression(i, "implied multiplication")
+                raise InvalidExpression(i, "missing operator")
+            text = expr[i:j]
+            append(Token(NAME, text, text, i))
+            expectOperand = False
+            i = j
+
+        else:
+            raise InvalidExpression(i, "unsupported character {!r}".format(ch))
+
+    if countTokens and len(tokens) > maxTokens:
+        raise LimitExceeded("tokens", maxTokens, tokens[maxTokens].position)
+    if not tokens:
+        raise InvalidExpression(start, "empty expression")
+    if expectOperand:
+        if tokens[-1].kind == OPERATOR:
+            raise InvalidExpression(tokens[-1].position, "expression cannot end with an operator")
+        raise InvalidExpression(end, "missing operand")
+    if depth != 0:
+        raise InvalidExpression(end, "unbalanced parenthesis")
+    return tokens